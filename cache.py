@@ -0,0 +1,177 @@
+"""Small caches with size-based eviction: in memory, and on disk.
+
+Each DiskCache entry is a pair of files named after the sha1 of its key: the body, and a
+JSON file of metadata. An entry's last use is the mtime of its body file, which
+is bumped on every hit, so eviction is least-recently-used.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class LRUCache(object):
+    """Keep bytes values in memory, evicting the least recently used over max_bytes.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        self.delete(key)
+        self.entries[key] = value
+        self.size += len(value)
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def delete(self, key):
+        value = self.entries.pop(key, None)
+        if value is not None:
+            self.size -= len(value)
+
+
+class DiskCache(object):
+
+    def __init__(self, directory, max_bytes=None, max_age=None):
+        self.directory = directory
+        self.max_bytes = max_bytes  # total size of bodies to keep, or None for no limit
+        self.max_age = max_age      # seconds since last use, or None for no limit
+
+    def _paths(self, key):
+        name = hashlib.sha1(key.encode('utf8')).hexdigest()
+        base = os.path.join(self.directory, name)
+        return base + '.body', base + '.json'
+
+    def get(self, key):
+        """Return (body, meta) for key, or None if it isn't cached (any more).
+        """
+        body_path, meta_path = self._paths(key)
+        try:
+            if self.max_age is not None and time.time() - os.stat(body_path).st_mtime > self.max_age:
+                self.delete(key)
+                return None
+            with open(meta_path, 'r') as fp:
+                meta = json.load(fp)
+            with open(body_path, 'rb') as fp:
+                body = fp.read()
+            os.utime(body_path, None)
+        except (OSError, ValueError):  # missing, evicted out from under us, or half-written
+            return None
+        return body, meta
+
+    def open(self, key):
+        """Like get, but return (fp, meta) with the body open for reading in binary mode.
+        """
+        body_path, meta_path = self._paths(key)
+        try:
+            if self.max_age is not None and time.time() - os.stat(body_path).st_mtime > self.max_age:
+                self.delete(key)
+                return None
+            with open(meta_path, 'r') as fp:
+                meta = json.load(fp)
+            fp = open(body_path, 'rb')
+            os.utime(body_path, None)
+        except (OSError, ValueError):
+            return None
+        return fp, meta
+
+    def set(self, key, body, **meta):
+        """Store body (bytes) and meta for key, then evict as needed.
+        """
+        with self.writing(key, **meta) as fp:
+            fp.write(body)
+
+    @contextmanager
+    def writing(self, key, **meta):
+        """Yield a binary file to write the body for key into, bit by bit.
+
+        The entry is only stored if the block exits cleanly.
+
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+        body_path, meta_path = self._paths(key)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                yield fp
+        except BaseException:
+            os.remove(tmp)
+            raise
+        os.replace(tmp, body_path)
+        meta['key'] = key
+        meta['stored_at'] = time.time()
+        self._write(meta_path, json.dumps(meta).encode('utf8'))
+        self.prune()
+
+    def _write(self, path, data):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+        os.replace(tmp, path)
+
+    def delete(self, key):
+        for path in self._paths(key):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def entries(self):
+        """Return a list of (last_used, size, base_path) for each entry, oldest first.
+        """
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return entries
+        for name in names:
+            if not name.endswith('.body'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path[:-len('.body')]))
+        return sorted(entries)
+
+    def prune(self):
+        """Evict entries older than max_age, then the least recently used until under max_bytes.
+        """
+        if self.max_bytes is None and self.max_age is None:
+            return
+        now = time.time()
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for last_used, size, base in entries:
+            too_old = self.max_age is not None and now - last_used > self.max_age
+            too_big = self.max_bytes is not None and total > self.max_bytes
+            if not (too_old or too_big):
+                continue
+            for path in (base + '.body', base + '.json'):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
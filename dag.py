@@ -1,7 +1,13 @@
-from copy import copy, deepcopy
+from array import array
+from bisect import bisect_left
+from collections import deque
+from copy import copy
 
 class DAGValidationError(Exception):
-    pass
+
+    def __init__(self, message='', cycles=()):
+        Exception.__init__(self, message)
+        self.cycles = list(cycles)
 
 class DAG(object):
     """ Directed acyclic graph implementation. """
@@ -9,6 +15,8 @@ class DAG(object):
     def __init__(self):
         """ Construct a new DAG with no nodes or edges. """
         self.graph = {}
+        self.reverse_graph = {}
+        self._closure = None
 
 
     def add_node(self, node_name, graph=None):
@@ -18,6 +26,9 @@ class DAG(object):
         if node_name in graph:
             raise KeyError('node %s already exists' % node_name)
         graph[node_name] = set()
+        if graph is self.graph:
+            self.reverse_graph[node_name] = set()
+            self._closure = None
 
 
     def delete_node(self, node_name, graph=None):
@@ -26,7 +37,15 @@ class DAG(object):
             graph = self.graph
         if node_name not in graph:
             raise KeyError('node %s does not exist' % node_name)
-        graph.pop(node_name)
+        edges = graph.pop(node_name)
+
+        if graph is self.graph:
+            self._closure = None
+            for node in self.reverse_graph.pop(node_name):
+                graph[node].discard(node_name)
+            for node in edges:
+                self.reverse_graph[node].discard(node_name)
+            return
 
         for node, edges in graph.items():
             if node_name in edges:
@@ -39,29 +58,59 @@ class DAG(object):
             graph = self.graph
         if ind_node not in graph or dep_node not in graph:
             raise KeyError('one or more nodes do not exist in graph')
-        test_graph = deepcopy(graph)
-        test_graph[ind_node].add(dep_node)
-        is_valid, message = self.validate(test_graph)
-        if is_valid:
-            graph[ind_node].add(dep_node)
-        else:
+        if ind_node == dep_node or self._reaches(dep_node, ind_node, graph):
             raise DAGValidationError()
-
-
-    def delete_edge(self, ind_node, dep_node):
+        graph[ind_node].add(dep_node)
+        if graph is self.graph:
+            self.reverse_graph[dep_node].add(ind_node)
+            self._closure = None
+
+
+    def _reaches(self, from_node, to_node, graph):
+        """ Returns whether to_node can be reached by following edges from from_node. """
+        if graph is self.graph and self._closure is not None:
+            return self.reaches(from_node, to_node)
+        stack, seen = [from_node], {from_node}
+        while stack:
+            for node in graph[stack.pop()]:
+                if node == to_node:
+                    return True
+                if node not in seen:
+                    seen.add(node)
+                    stack.append(node)
+        return False
+
+
+    def delete_edge(self, ind_node, dep_node, graph=None):
         """ Delete an edge from the graph. """
         if not graph:
             graph = self.graph
         if dep_node not in graph.get(ind_node, []):
             raise KeyError('this edge does not exist in graph')
         graph[ind_node].remove(dep_node)
+        if graph is self.graph:
+            self.reverse_graph[dep_node].remove(ind_node)
+            self._closure = None
 
 
-    def rename_edges(self, old_task_name, new_task_name):
+    def rename_edges(self, old_task_name, new_task_name, graph=None):
         """ Change references to a task in existing edges. """
         if not graph:
             graph = self.graph
-        for node, edges in graph.items():
+
+        if graph is self.graph:
+            self._closure = None
+            edges = graph[new_task_name] = graph.pop(old_task_name)
+            for node in edges:
+                self.reverse_graph[node].remove(old_task_name)
+                self.reverse_graph[node].add(new_task_name)
+            incoming = self.reverse_graph[new_task_name] = self.reverse_graph.pop(old_task_name)
+            for node in incoming:
+                graph[node].remove(old_task_name)
+                graph[node].add(new_task_name)
+            return
+
+        for node, edges in list(graph.items()):
 
             if node == old_task_name:
                 graph[new_task_name] = copy(edges)
@@ -77,9 +126,18 @@ class DAG(object):
         """ Returns a list of all predecessors of the given node """
         if graph is None:
             graph = self.graph
+        if graph is self.graph:
+            return self.incoming(node)
         return [key for key in graph if node in graph[key]]
 
 
+    def incoming(self, node):
+        """ Returns a list of all nodes with edges towards this node. """
+        if node not in self.reverse_graph:
+            raise KeyError('node %s is not in graph' % node)
+        return list(self.reverse_graph[node])
+
+
     def downstream(self, node, graph=None):
         """ Returns a list of all nodes this node has edges towards. """
         if graph is None:
@@ -94,6 +152,8 @@ class DAG(object):
         topological order."""
         if graph is None:
             graph = self.graph
+        if graph is self.graph:
+            return self._closure_lookup(node, 'downstreams')
         nodes = [node]
         nodes_seen = set()
         i = 0
@@ -104,7 +164,67 @@ class DAG(object):
                     nodes_seen.add(downstream_node)
                     nodes.append(downstream_node)
             i += 1
-        return filter(lambda node: node in nodes_seen, self.topological_sort(graph=graph))
+        return [node for node in self.topological_sort(graph=graph) if node in nodes_seen]
+
+    def all_upstreams(self, node):
+        """Returns a list of all nodes the given node is ultimately
+        downstream of, in topological order."""
+        return self._closure_lookup(node, 'upstreams')
+
+    def reaches(self, ind_node, dep_node):
+        """ Returns whether dep_node is ultimately downstream of ind_node. """
+        closure = self._reachability()
+        if ind_node not in closure['position'] or dep_node not in closure['position']:
+            raise KeyError('one or more nodes do not exist in graph')
+        position = closure['position']
+        return bool(closure['descendants'][position[ind_node]] >> position[dep_node] & 1)
+
+    def _reachability(self):
+        """Build (once per mutation) the transitive closure of the graph.
+
+        Nodes are numbered in topological order and each node's descendants
+        and ancestors are kept as int bitsets, built in a single pass each way.
+        """
+        if self._closure is None:
+            order = self.topological_sort()
+            position = {node: i for i, node in enumerate(order)}
+            descendants = [0] * len(order)
+            for i in range(len(order) - 1, -1, -1):
+                bits = 0
+                for node in self.graph[order[i]]:
+                    j = position[node]
+                    bits |= descendants[j] | (1 << j)
+                descendants[i] = bits
+            ancestors = [0] * len(order)
+            for i in range(len(order)):
+                bits = 0
+                for node in self.reverse_graph[order[i]]:
+                    j = position[node]
+                    bits |= ancestors[j] | (1 << j)
+                ancestors[i] = bits
+            self._closure = { 'order': order
+                            , 'position': position
+                            , 'descendants': descendants
+                            , 'ancestors': ancestors
+                            , 'downstreams': {}
+                            , 'upstreams': {}
+                             }
+        return self._closure
+
+    def _closure_lookup(self, node, kind):
+        closure = self._reachability()
+        cache = closure[kind]
+        if node not in cache:
+            if node not in closure['position']:
+                raise KeyError('node %s is not in graph' % node)
+            bitsets = closure['descendants' if kind == 'downstreams' else 'ancestors']
+            bits, order, nodes = bitsets[closure['position'][node]], closure['order'], []
+            while bits:
+                low = bits & -bits
+                nodes.append(order[low.bit_length() - 1])
+                bits ^= low
+            cache[node] = nodes
+        return list(cache[node])
 
     def all_leaves(self, graph=None):
         """ Return a list of all leaves (nodes with no downstreams) """
@@ -119,18 +239,53 @@ class DAG(object):
         """
 
         self.reset_graph()
-        for new_node in graph_dict.iterkeys():
-            self.add_node(new_node)
-        for ind_node, dep_nodes in graph_dict.items():
+        for dep_nodes in graph_dict.values():
             if not isinstance(dep_nodes, list):
                 raise TypeError('dict values must be lists')
-            for dep_node in dep_nodes:
-                self.add_edge(ind_node, dep_node)
+        edges = [(ind_node, dep_node) for ind_node, dep_nodes in graph_dict.items()
+                                      for dep_node in dep_nodes]
+        built = self.from_edges(graph_dict, edges)
+        self.graph, self.reverse_graph = built.graph, built.reverse_graph
+        self._closure = None
+
+
+    @classmethod
+    def from_edges(cls, nodes, edges):
+        """ Build a new DAG from node names and (ind_node, dep_node) pairs.
+
+        All edges are loaded first and the graph is validated once at the
+        end, so this is O(V+E) rather than a validation per edge. If there
+        are cycles, a single DAGValidationError lists all of them.
+        """
+        dag = cls()
+        for node in nodes:
+            if node in dag.graph:
+                raise KeyError('node %s already exists' % node)
+            dag.graph[node] = set()
+            dag.reverse_graph[node] = set()
+        for ind_node, dep_node in edges:
+            if ind_node not in dag.graph or dep_node not in dag.graph:
+                raise KeyError('one or more nodes do not exist in graph')
+            dag.graph[ind_node].add(dep_node)
+            dag.reverse_graph[dep_node].add(ind_node)
+
+        cycles = dag.find_cycles()
+        if cycles:
+            message = '; '.join(' -> '.join(cycle) for cycle in cycles)
+            raise DAGValidationError('graph is not acyclic: ' + message, cycles)
+        return dag
+
+
+    def compact(self):
+        """ Returns a read-only CompactDAG with the same nodes and edges. """
+        return CompactDAG.from_dag(self)
 
 
     def reset_graph(self):
         """ Restore the graph to an empty state. """
         self.graph = {}
+        self.reverse_graph = {}
+        self._closure = None
 
 
     def ind_nodes(self, graph):
@@ -155,10 +310,91 @@ class DAG(object):
         return (True, 'valid')
 
 
+    def find_cycles(self, graph=None):
+        """ Returns a list of cycles, one for each strongly connected component.
+
+        Each cycle is a list of nodes that starts and ends with the same node.
+        An empty list means the graph is acyclic.
+        """
+        graph = graph if graph is not None else self.graph
+
+        # Whatever survives Kahn's algorithm is on or downstream of a cycle.
+        in_degree = dict.fromkeys(graph, 0)
+        for downstream_nodes in graph.values():
+            for node in downstream_nodes:
+                in_degree[node] += 1
+        q = deque(node for node in graph if in_degree[node] == 0)
+        while q:
+            for m in graph[q.popleft()]:
+                in_degree[m] -= 1
+                if in_degree[m] == 0:
+                    q.append(m)
+        remaining = {node for node in graph if in_degree[node] > 0}
+
+        cycles = []
+        for component in self._components(remaining, graph):
+            if len(component) == 1:
+                node = next(iter(component))
+                if node in graph[node]:
+                    cycles.append([node, node])
+                continue
+
+            # Walk the component until we come back around to a node we've seen.
+            path, positions = [], {}
+            node = min(component)
+            while node not in positions:
+                positions[node] = len(path)
+                path.append(node)
+                node = min(m for m in graph[node] if m in component)
+            cycles.append(path[positions[node]:] + [node])
+        return sorted(cycles)
+
+
+    def _components(self, nodes, graph):
+        """ Returns the strongly connected components among nodes (iterative Tarjan). """
+        index, lowlink, on_stack = {}, {}, set()
+        stack, components = [], []
+        for root in sorted(nodes):
+            if root in index:
+                continue
+            work = [(root, iter(sorted(m for m in graph[root] if m in nodes)))]
+            index[root] = lowlink[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            while work:
+                node, children = work[-1]
+                for child in children:
+                    if child not in index:
+                        index[child] = lowlink[child] = len(index)
+                        stack.append(child)
+                        on_stack.add(child)
+                        work.append((child, iter(sorted(m for m in graph[child] if m in nodes))))
+                        break
+                    elif child in on_stack:
+                        lowlink[node] = min(lowlink[node], index[child])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent], lowlink[node])
+                    if lowlink[node] == index[node]:
+                        component = set()
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            component.add(member)
+                            if member == node:
+                                break
+                        components.append(component)
+        return components
+
+
     def _dependencies(self, target_node, graph):
         """ Returns a list of all nodes from incoming edges. """
         if graph is None:
             raise Exception("Graph given is None")
+        if graph is self.graph:
+            return list(self.reverse_graph[target_node])
         result = set()
         for node, outgoing_nodes in graph.items():
             if target_node in outgoing_nodes:
@@ -169,20 +405,186 @@ class DAG(object):
     def topological_sort(self, graph=None):
         """ Returns a topological ordering of the DAG.
 
+        This is Kahn's algorithm driven by in-degree counters, so it runs in
+        O(V+E) and leaves the graph untouched. Ties are broken by node name,
+        which makes the ordering stable from run to run.
+
         Raises an error if this is not possible (graph is not valid).
         """
-        graph = deepcopy(graph if graph is not None else self.graph)
+        graph = graph if graph is not None else self.graph
+        in_degree = dict.fromkeys(graph, 0)
+        for downstream_nodes in graph.values():
+            for node in downstream_nodes:
+                in_degree[node] += 1
         l = []
-        q = deepcopy(self.ind_nodes(graph))
-        while len(q) != 0:
-            n = q.pop(0)
+        q = deque(sorted(node for node in graph if in_degree[node] == 0))
+        while q:
+            n = q.popleft()
             l.append(n)
-            iter_nodes = deepcopy(graph[n])
-            for m in iter_nodes:
-                graph[n].remove(m)
-                if len(self._dependencies(m, graph)) == 0:
+            for m in sorted(graph[n]):
+                in_degree[m] -= 1
+                if in_degree[m] == 0:
                     q.append(m)
 
-        if len(l) != len(graph.keys()):
+        if len(l) != len(graph):
             raise ValueError('graph is not acyclic')
         return l
+
+
+class CompactDAG(object):
+    """ Read-only DAG with interned node names and CSR adjacency arrays.
+
+    Node names are interned to integer ids (their position in the sorted
+    names tuple), and edges are stored as flat arrays of ids, indexed by
+    per-node offsets. That is a few bytes per edge instead of a set per node,
+    and traversals walk contiguous memory. Build one with from_edges or
+    from_dag; the query methods mirror DAG's.
+    """
+
+    def __init__(self, names, offsets, targets, reverse_offsets, reverse_targets):
+        self.names = names
+        self.offsets = offsets
+        self.targets = targets
+        self.reverse_offsets = reverse_offsets
+        self.reverse_targets = reverse_targets
+        self._order = None
+
+
+    @classmethod
+    def from_edges(cls, nodes, edges):
+        """ Build a CompactDAG from node names and (ind_node, dep_node) pairs. """
+        names = tuple(sorted(nodes))
+        for a, b in zip(names, names[1:]):
+            if a == b:
+                raise KeyError('node %s already exists' % a)
+        compact = cls(names, None, None, None, None)
+        pairs = [(compact.id_of(a), compact.id_of(b)) for a, b in edges]
+        pairs = sorted(set(pairs))
+        compact.offsets, compact.targets = cls._csr(len(names), pairs)
+        compact.reverse_offsets, compact.reverse_targets = \
+                cls._csr(len(names), sorted((b, a) for a, b in pairs))
+
+        try:
+            compact.topological_sort()
+        except ValueError:
+            cycles = DAG().find_cycles(compact.to_dag().graph)
+            message = '; '.join(' -> '.join(cycle) for cycle in cycles)
+            raise DAGValidationError('graph is not acyclic: ' + message, cycles)
+        return compact
+
+
+    @classmethod
+    def from_dag(cls, dag):
+        """ Build a CompactDAG from a DAG. """
+        graph = dag.graph
+        return cls.from_edges(graph, ((a, b) for a in graph for b in graph[a]))
+
+
+    @staticmethod
+    def _csr(nnodes, pairs):
+        """ Pack sorted (source, target) id pairs into offset and target arrays. """
+        offsets = array('i', [0] * (nnodes + 1))
+        for source, target in pairs:
+            offsets[source + 1] += 1
+        for i in range(nnodes):
+            offsets[i + 1] += offsets[i]
+        return offsets, array('i', [target for source, target in pairs])
+
+
+    def to_dag(self):
+        """ Returns a mutable DAG with the same nodes and edges. """
+        dag = DAG()
+        for node in self.names:
+            dag.graph[node] = set(self.downstream(node))
+            dag.reverse_graph[node] = set(self.incoming(node))
+        return dag
+
+
+    def __len__(self):
+        return len(self.names)
+
+
+    def __contains__(self, node):
+        i = bisect_left(self.names, node)
+        return i < len(self.names) and self.names[i] == node
+
+
+    def id_of(self, node):
+        """ Returns the interned integer id of the given node. """
+        i = bisect_left(self.names, node)
+        if i == len(self.names) or self.names[i] != node:
+            raise KeyError('node %s is not in graph' % node)
+        return i
+
+
+    def _successors(self, i):
+        return self.targets[self.offsets[i]:self.offsets[i + 1]]
+
+
+    def _predecessors(self, i):
+        return self.reverse_targets[self.reverse_offsets[i]:self.reverse_offsets[i + 1]]
+
+
+    def downstream(self, node):
+        """ Returns a list of all nodes this node has edges towards. """
+        return [self.names[i] for i in self._successors(self.id_of(node))]
+
+
+    def incoming(self, node):
+        """ Returns a list of all nodes with edges towards this node. """
+        return [self.names[i] for i in self._predecessors(self.id_of(node))]
+
+    predecessors = incoming
+
+
+    def all_downstreams(self, node):
+        """ Returns a list of all nodes ultimately downstream of the given node,
+        in topological order. """
+        seen = set()
+        stack = [self.id_of(node)]
+        while stack:
+            for i in self._successors(stack.pop()):
+                if i not in seen:
+                    seen.add(i)
+                    stack.append(i)
+        return [self.names[i] for i in self._topological_ids() if i in seen]
+
+
+    def all_leaves(self):
+        """ Return a list of all leaves (nodes with no downstreams) """
+        offsets = self.offsets
+        return [self.names[i] for i in range(len(self.names)) if offsets[i] == offsets[i + 1]]
+
+
+    def ind_nodes(self):
+        """ Returns a list of all nodes in the graph with no dependencies. """
+        offsets = self.reverse_offsets
+        return [self.names[i] for i in range(len(self.names)) if offsets[i] == offsets[i + 1]]
+
+
+    def _topological_ids(self):
+        if self._order is None:
+            offsets = self.reverse_offsets
+            in_degree = array('i', (offsets[i + 1] - offsets[i] for i in range(len(self.names))))
+            order = array('i')
+            q = deque(i for i in range(len(self.names)) if in_degree[i] == 0)
+            while q:
+                n = q.popleft()
+                order.append(n)
+                for m in self._successors(n):
+                    in_degree[m] -= 1
+                    if in_degree[m] == 0:
+                        q.append(m)
+            if len(order) != len(self.names):
+                raise ValueError('graph is not acyclic')
+            self._order = order
+        return self._order
+
+
+    def topological_sort(self):
+        """ Returns a topological ordering of the DAG.
+
+        Ids follow name order and adjacency rows are sorted, so this matches
+        DAG.topological_sort exactly. The ordering is computed once and cached.
+        """
+        return [self.names[i] for i in self._topological_ids()]
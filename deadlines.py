@@ -0,0 +1,53 @@
+"""Deadlines for long-running work, checked cooperatively.
+
+Map generation can run for a very long time on a pathological input, and
+there's no safe way to interrupt a thread (or a pool process, without
+losing it). Instead, genmap and pathways_solver take an optional Deadline
+and call check() at points where stopping is safe: between fill_one
+attempts, between MagnitudeMap.add calls, and every so many solver nodes.
+
+A Deadline is just a number of seconds and an absolute time, so it pickles,
+and means the same thing in a pool process as it did in the server. One made
+with start=False doesn't count down until start() is called, so that work
+handed to a busy pool isn't charged for the time it waits there.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import time
+from math import inf
+
+
+class DeadlineExceeded(Exception): pass
+
+
+class Deadline(object):
+
+    def __init__(self, seconds, start=True):
+        self.seconds = seconds
+        self.at = time.time() + seconds if start else inf
+        self.cancelled = False
+
+    def start(self):
+        """Count down from now, unless we've been cancelled.
+        """
+        if not self.cancelled:
+            self.at = time.time() + self.seconds
+
+    def remaining(self):
+        return self.at - time.time()
+
+    def expired(self):
+        return time.time() >= self.at
+
+    def cancel(self):
+        """Expire now, so the next check raises.
+        """
+        self.cancelled = True
+        self.at = time.time()
+
+    def check(self):
+        if time.time() >= self.at:
+            if self.cancelled:
+                raise DeadlineExceeded('cancelled')
+            raise DeadlineExceeded('gave up after {:.0f} seconds'.format(self.seconds))
@@ -3,44 +3,177 @@
 
 https://developers.google.com/google-apps/spreadsheets/
 
-The result of this script is a JSON file at ./output/topics.json.
+The result of this script is a JSON file at ./output/topics.json, plus a
+compact snapshot of it for genmap at ./output/topics.snapshot.
 
 """
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import csv
+import hashlib
 import io
 import json
 import os
 import re
 import shutil
+import time
 from collections import defaultdict
+from concurrent.futures import CancelledError, ThreadPoolExecutor, TimeoutError
+from cache import DiskCache
 from dag import DAG
+import snapshot
 import xml.etree.ElementTree as ET
 
 import requests
 
 
-def _get(url):
-    print("Getting {} ...".format(url))
-    response = requests.get(url, headers={'If-Modified-Since': 'Wed, 16 Feb 2011 13:52:26 GMT'})
+SHEETS_KEY = '10PurQxMbALCYNu7I3KfgUb2oMz4Uk5dLPZbTkdNb0ZM'
+
+# Worksheets are downloaded concurrently over one keep-alive session.
+MAX_WORKERS = 8
+
+# Seconds to wait on any one request (to connect, or between bytes), and on a
+# whole refresh. A worksheet that misses either falls back to its cached copy.
+REQUEST_TIMEOUT = 30
+REFRESH_TIMEOUT = 300
+
+# The columns the map pipeline itself needs. When streaming with a list of
+# display fields, everything else is dropped as rows are parsed.
+PIPELINE_FIELDS = ('uid', 'subtopic_id', 'before_this', 'after_this')
+
+session = requests.Session()
+session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=MAX_WORKERS))
+session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=MAX_WORKERS))
+
+# Responses are cached on disk with their validators, so that unchanged sheets
+# come back as a bodiless 304.
+cache = DiskCache( os.path.join('output', '.cache')
+                 , max_bytes=64 * 1024 * 1024
+                 , max_age=30 * 24 * 60 * 60
+                  )
+
+
+class SheetUnavailable(Exception): pass
+
+
+def _validators(meta):
+    headers = {}
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+    return headers
+
+
+def _check_status(url, response):
     if not response.status_code == 200:
         print("Problem downloading {} ...".format(url))
         print(response.status_code)
         print(response.text)
+        raise SheetUnavailable(url, response.status_code)
+
+
+def _sign_in_problem(url):
+    print("Problem downloading {} ...".format(url))
+    print("They're asking us to sign in. Try 'File > Publish to the web ...'.")
+    raise SheetUnavailable(url, 'sign in')
+
+
+def _cached_copy(url):
+    """Return the last copy of url we downloaded, for when we can't get a fresh one.
+    """
+    cached = cache.get(url)
+    if cached is None:
+        print("No cached copy of {} to fall back on.".format(url))
         raise SystemExit
+    print("Falling back to the cached copy of {} ...".format(url))
+    return cached[0].decode('utf8')
+
+
+def _get_or_cached(url):
+    try:
+        return _get(url)
+    except (SheetUnavailable, requests.RequestException):
+        return _cached_copy(url)
+
+
+def _get(url):
+    print("Getting {} ...".format(url))
+    cached = cache.get(url)
+    headers = _validators(cached[1]) if cached is not None else {}
+    response = session.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+    if response.status_code == 304 and cached is not None:
+        print("Not modified: {}".format(url))
+        return cached[0].decode('utf8')
+    _check_status(url, response)
     if 'Sign in to continue to Sheets' in response.text:
-        print("Problem downloading {} ...".format(url))
-        print("They're asking us to sign in. Try 'File > Publish to the web ...'.")
-        raise SystemExit
+        _sign_in_problem(url)
+    cache.set( url
+             , response.text.encode('utf8')
+             , etag=response.headers.get('ETag')
+             , last_modified=response.headers.get('Last-Modified')
+              )
     return response.text
 
 
+def _stream(url):
+    """Like _get, but generate the body line by line (newlines included) as it arrives.
+
+    The body is written through to the cache as we go, and is never held in
+    memory as a whole.
+
+    """
+    print("Streaming {} ...".format(url))
+    cached = cache.open(url)
+    headers = _validators(cached[1]) if cached is not None else {}
+    try:
+        response = session.get(url, headers=headers, stream=True, timeout=REQUEST_TIMEOUT)
+    except BaseException:
+        if cached is not None:
+            cached[0].close()
+        raise
+    try:
+        if response.status_code == 304 and cached is not None:
+            print("Not modified: {}".format(url))
+            with cached[0] as fp:
+                for line in fp:
+                    yield line.decode('utf8')
+            return
+        if cached is not None:
+            cached[0].close()
+        _check_status(url, response)
+        response.encoding = response.encoding or 'utf8'
+        with cache.writing( url
+                          , etag=response.headers.get('ETag')
+                          , last_modified=response.headers.get('Last-Modified')
+                           ) as fp:
+            for line in _lines(response.iter_content(chunk_size=8192, decode_unicode=True)):
+                if 'Sign in to continue to Sheets' in line:
+                    _sign_in_problem(url)
+                fp.write(line.encode('utf8'))
+                yield line
+    finally:
+        response.close()
+
+
+def _lines(chunks):
+    """Regroup text chunks into lines, keeping the newlines so nothing is lost.
+    """
+    pending = ''
+    for chunk in chunks:
+        lines = (pending + chunk).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if pending:
+        yield pending
+
+
 def fetch_worksheets(sheet_key):
     csv_url = "https://docs.google.com/spreadsheets/d/{}/pub?gid={}&single=true&output=csv"
     listing_url = "https://spreadsheets.google.com/feeds/worksheets/{}/public/basic"
     listing_url = listing_url.format(sheet_key)
-    raw = _get(listing_url)
+    raw = _get_or_cached(listing_url)
     tree = ET.fromstring(raw)
     ns = {'atom': 'http://www.w3.org/2005/Atom'}
     entries = tree.findall('./atom:entry', ns)
@@ -51,7 +184,7 @@ def fetch_worksheets(sheet_key):
     return [(xtitle(e), puburl(xgid(xcsvurl(e)))) for e in entries]
 
 
-def fetch_resources_by_topic(worksheets):
+def fetch_resources_by_topic(worksheets, max_workers=MAX_WORKERS):
     """Smooth out into a nice JSON-able data structure.
 
     { "deadbeef": { "id": "deadbeef"
@@ -68,74 +201,235 @@ def fetch_resources_by_topic(worksheets):
                                                               }
                                                }
                    }
+
+    Worksheets are downloaded in parallel by up to max_workers threads, and
+    parsed in worksheet order as they come in. Topics built from cached
+    copies, because their worksheet couldn't be downloaded, are flagged
+    with "stale": true, as in update_topics.
+
     """
     topics = {}
-    for topic_id, csvurl in worksheets:
-        topic = {}
-        topic['id'] = topic_id
-        topic['subtopics'] = subtopics = defaultdict(lambda: defaultdict(dict))
+    for topic_id, raw, stale in fetch_csvs(worksheets, max_workers):
+        topics[topic_id] = build_topic(topic_id, raw)
+        if stale:
+            topics[topic_id]['stale'] = True
+    return topics
+
+
+def _gather(worksheets, work, max_workers, deadline):
+    """Run work(topic_id, csvurl) for each worksheet on a thread pool.
+
+    Generate (topic_id, csvurl, result) in worksheet order, where result is
+    None if the work failed to download its sheet, or didn't finish before
+    deadline (a time.time(), or None to wait as long as it takes).
+
+    """
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    futures = []
+    try:
+        futures = [pool.submit(work, topic_id, csvurl) for topic_id, csvurl in worksheets]
+        for (topic_id, csvurl), future in zip(worksheets, futures):
+            timeout = None if deadline is None else max(0, deadline - time.time())
+            try:
+                result = future.result(timeout)
+            except (TimeoutError, CancelledError):
+                print("Gave up waiting for {} ...".format(csvurl))
+                for later in futures:
+                    later.cancel()  # past the deadline, so don't start any more downloads
+                result = None
+            except (SheetUnavailable, requests.RequestException) as exc:
+                print("Problem downloading {}: {!r}".format(csvurl, exc))
+                result = None
+            yield topic_id, csvurl, result
+    finally:
+        for future in futures:
+            future.cancel()
+        pool.shutdown(wait=False)  # don't wait on stragglers; REQUEST_TIMEOUT will end them
+
+
+def fetch_csvs(worksheets, max_workers=MAX_WORKERS, deadline=None):
+    """Generate (topic_id, raw CSV, stale) for each worksheet, in worksheet order.
+
+    A worksheet we can't download by deadline falls back to its cached copy,
+    and is flagged as stale.
+
+    """
+    for topic_id, csvurl, raw in _gather(worksheets, lambda t, u: _get(u), max_workers, deadline):
+        if raw is None:
+            yield topic_id, _cached_copy(csvurl), True
+        else:
+            yield topic_id, raw, False
+
+
+def update_topics(worksheets, topics, hashes, max_workers=MAX_WORKERS, stream=False, fields=None,
+        deadline=None):
+    """Rebuild only those topics whose worksheet CSV has changed.
+
+    topics and hashes are what we built last time: the topics themselves, and
+    the sha1 of the CSV each was built from. Return new topics and hashes,
+    along with a sorted list of the ids of topics that were added, changed, or
+    removed.
 
-        raw = _get(csvurl)
-        reader = csv.reader(io.StringIO(raw))
-        headers = next(reader)
+    Changed topics are validated along the way. When streaming, every sheet
+    is parsed as it downloads (that's the point), but topics whose CSV is
+    unchanged are still taken from the last build.
 
-        for row in reader:
+    Topics built from a cached copy because their worksheet couldn't be
+    downloaded by deadline are flagged with "stale": true. A topic going
+    stale or fresh again counts as a change.
+
+    """
+    new_topics, new_hashes, changed, bad = {}, {}, set(), set()
+    builders = _fetch_builders(worksheets, max_workers, stream, fields, deadline)
+    for topic_id, sha1, build, stale in builders:
+        new_hashes[topic_id] = sha1
+        if topic_id in topics and hashes.get(topic_id) == sha1:
+            topic = topics[topic_id]
+        else:
+            topic, topic_bad = build()
+            bad.update(topic_bad)
+            changed.add(topic_id)
+        if topic.get('stale', False) != stale:
+            topic = dict(topic)
+            if stale:
+                topic['stale'] = True
+            else:
+                del topic['stale']
+            changed.add(topic_id)
+        new_topics[topic_id] = topic
+    report_bad_uids(bad)
+    changed.update(set(topics) - set(new_topics))
+    return new_topics, new_hashes, sorted(changed)
+
+
+def _fetch_builders(worksheets, max_workers, stream, fields, deadline):
+    """Generate (topic_id, sha1, build, stale) per worksheet, where build returns (topic, bad uids).
+    """
+    def builder(topic_id, raw):
+        def build():
+            topic = build_topic(topic_id, raw, fields)
+            return topic, set(b for resource in _resources(topic)
+                                for b in bad_uids(topic_id, resource))
+        return hashlib.sha1(raw.encode('utf8')).hexdigest(), build
+
+    if stream:
+        work = lambda topic_id, csvurl: stream_topic(topic_id, csvurl, fields)
+        for topic_id, csvurl, result in _gather(worksheets, work, max_workers, deadline):
+            if result is None:
+                sha1, build = builder(topic_id, _cached_copy(csvurl))
+                yield topic_id, sha1, build, True
+            else:
+                topic, sha1, bad = result
+                yield topic_id, sha1, lambda topic=topic, bad=bad: (topic, bad), False
+    else:
+        for topic_id, raw, stale in fetch_csvs(worksheets, max_workers, deadline):
+            sha1, build = builder(topic_id, raw)
+            yield topic_id, sha1, build, stale
+
+
+def _resources(topic):
+    for subtopic in topic['subtopics'].values():
+        for resource in subtopic['resources'].values():
+            yield resource
+
+
+def build_topic(topic_id, raw, fields=None):
+    """Parse one worksheet's CSV into a topic, including its subtopic DAGs.
+    """
+    return _topic_from_rows(topic_id, csv.reader(io.StringIO(raw)), fields)
+
+
+def stream_topic(topic_id, csvurl, fields=None):
+    """Download and parse one worksheet in a single streaming pass.
+
+    Rows are parsed as they arrive, and only the columns the map pipeline
+    needs (plus fields, if given) are kept. Return (topic, sha1 of the CSV,
+    bad uids), where the uid checks from validate_uids are done in the same
+    pass.
+
+    """
+    sha1 = hashlib.sha1()
+    def lines():
+        for line in _stream(csvurl):
+            sha1.update(line.encode('utf8'))
+            yield line
+    bad = set()
+    topic = _topic_from_rows(topic_id, csv.reader(lines()), fields, bad)
+    return topic, sha1.hexdigest(), bad
+
+
+def _topic_from_rows(topic_id, reader, fields=None, bad=None):
+    topic = {}
+    topic['id'] = topic_id
+    topic['subtopics'] = subtopics = defaultdict(lambda: defaultdict(dict))
+
+    headers = next(reader)
+    keep = None if fields is None else set(PIPELINE_FIELDS).union(fields)
+
+    for row in reader:
+        if keep is None:
             resource = dict(zip(headers, row))
-            resource['id'] = resource['uid']
-            resource['topic_id'] = topic_id
-
-            subtopic = subtopics[resource['subtopic_id']]
-            subtopic['resources'][resource['id']] = resource
-
-            if 'dag' not in subtopic:
-                # First time seeing it. Populate!
-                subtopic['dag'] = DAG()
-                subtopic['id'] = resource['subtopic_id']
-                subtopic['topic_id'] = topic_id
-
-
-        # Populate DAGs.
-        # ==============
-        # We have to do this in a second loop so that we can tell whether
-        # before_this and after_this are in fact in the same subtopic as a
-        # given resource. The base data is not clean on this point.
-
-        for subtopic in subtopics.values():
-            for resource in subtopic['resources'].values():
-
-                # Relax the py-dag API to be more like the js DAG we had.
-                d = subtopic['dag']
-                add_node = lambda node: d.add_node(node) if node and node not in d.graph else None
-                add_edge = lambda a,b: d.add_edge(a,b) if a and b and a != b else None
-
-                add_node(resource['id'])
-                if resource['before_this'] in subtopic['resources']:
-                    add_node(resource['before_this'])
-                    add_edge(resource['before_this'], resource['id'])
-                if resource['after_this'] in subtopic['resources']:
-                    add_node(resource['after_this'])
-                    add_edge(resource['id'], resource['after_this'])
-
-        # Convert DAGs to the format that the JavaScript expects.
-        for subtopic in subtopics.values():
-            dag = subtopic['dag']
-            subtopic['dag'] = { "names": dag.topological_sort()
-                              , "vertices": \
-                                      {k: {"incomingNames": list(dag.graph[k])} for k in dag.graph}
-                               }
-
-        topics[topic_id] = topic
-    return topics
+        else:
+            resource = {k: v for k, v in zip(headers, row) if k in keep}
+        if bad is not None:
+            bad.update(bad_uids(topic_id, resource))
+        resource['id'] = resource['uid']
+        resource['topic_id'] = topic_id
+
+        subtopic = subtopics[resource['subtopic_id']]
+        subtopic['resources'][resource['id']] = resource
+
+        if 'id' not in subtopic:
+            # First time seeing it. Populate!
+            subtopic['id'] = resource['subtopic_id']
+            subtopic['topic_id'] = topic_id
+
+
+    # Populate DAGs.
+    # ==============
+    # We have to do this in a second loop so that we can tell whether
+    # before_this and after_this are in fact in the same subtopic as a
+    # given resource. The base data is not clean on this point.
+
+    for subtopic in subtopics.values():
+        resources = subtopic['resources']
+        edges = []
+        for resource in resources.values():
+            uid, before, after = resource['id'], resource['before_this'], resource['after_this']
+            if uid and before and before != uid and before in resources:
+                edges.append((before, uid))
+            if uid and after and after != uid and after in resources:
+                edges.append((uid, after))
+        subtopic['dag'] = DAG.from_edges([uid for uid in resources if uid], edges)
+
+    # Convert DAGs to the format that the JavaScript expects.
+    for subtopic in subtopics.values():
+        dag = subtopic['dag']
+        subtopic['dag'] = { "names": dag.topological_sort()
+                          , "vertices": \
+                                  {k: {"incomingNames": list(dag.graph[k])} for k in dag.graph}
+                           }
+
+    return topic
+
+
+def bad_uids(name, resource):
+    bad = []
+    for field in ('uid', 'before_this', 'after_this'):
+        if '\n' in resource[field] or not re.match(r'^[a-z0-9-]*$', resource[field]):
+            bad.append((name, field, resource[field].encode('ascii', errors='replace')))
+    return bad
 
 
 def validate_uids(topics):
     bad = set()
     for name, topic in topics.items():
-        for subtopic in topic['subtopics'].values():
-            for resource in subtopic['resources'].values():
-                for field in ('uid', 'before_this', 'after_this'):
-                    if '\n' in resource[field] or not re.match(r'^[a-z0-9-]*$', resource[field]):
-                        bad.add((name, field, resource[field].encode('ascii', errors='replace')))
+        for resource in _resources(topic):
+            bad.update(bad_uids(name, resource))
+    report_bad_uids(bad)
+
+
+def report_bad_uids(bad):
     if bad:
         print("{} bad uid(s)!".format(len(bad)))
         print("{:24} {:24} {:24}".format("sheet", "field", "value"))
@@ -145,23 +439,127 @@ def validate_uids(topics):
         raise SystemExit
 
 
-def dump_topics(topics, fspath):
-    fp = open(fspath, 'w+')
-    json.dump(topics, fp, sort_keys=True, indent=4, separators=(',', ': '))
+def dump_topics(topics, fspath, snapshot_fspath=None):
+    """Write topics as JSON to fspath, and as a compact snapshot to snapshot_fspath if given.
+    """
+    with open(fspath, 'w+') as fp:
+        json.dump(topics, fp, sort_keys=True, indent=4, separators=(',', ': '))
+    if snapshot_fspath is not None:
+        snapshot.dump(topics, snapshot_fspath)
 
 
-def main(sheets_key, staging_filepath, final_filepath):
-    worksheets = fetch_worksheets(sheets_key)
-    topics = fetch_resources_by_topic(worksheets)
-    validate_uids(topics)
-    dump_topics(topics, staging_filepath)
-    shutil.move(staging_filepath, final_filepath)
+def snapshot_path(final_filepath):
+    """Return the path of the snapshot that goes with a topics.json.
+    """
+    return os.path.splitext(final_filepath)[0] + '.snapshot'
 
 
-if __name__ == '__main__':
+def manifest_path(final_filepath):
+    """Return the path of the manifest that goes with a topics.json.
+    """
+    head, tail = os.path.split(final_filepath)
+    return os.path.join(head, '.' + os.path.splitext(tail)[0] + '.manifest.json')
+
 
-    sheets_key = '10PurQxMbALCYNu7I3KfgUb2oMz4Uk5dLPZbTkdNb0ZM'
+def load_manifest(final_filepath):
+    """Return (topics, hashes) from the last build, or empty ones if there's no usable build.
+    """
+    try:
+        with open(manifest_path(final_filepath)) as fp:
+            hashes = json.load(fp)['hashes']
+        with open(final_filepath) as fp:
+            topics = json.load(fp)
+    except (IOError, ValueError, KeyError):
+        return {}, {}
+    return topics, hashes
+
+
+def dump_manifest(hashes, changed, stale, final_filepath):
+    path = manifest_path(final_filepath)
+    staging = path + '.tmp'
+    with open(staging, 'w+') as fp:
+        json.dump({'hashes': hashes, 'changed': changed, 'stale': stale}, fp, sort_keys=True,
+                  indent=4)
+    shutil.move(staging, path)
+
+
+def main(source, staging_filepath, final_filepath, incremental=False, stream=False,
+        fields=None, timeout=REFRESH_TIMEOUT):
+    """Fetch topics and write them to final_filepath, by way of staging_filepath.
+
+    source is a Google Sheets key, or a source from sources.py.
+
+    In incremental mode, only worksheets whose CSV has changed since the last
+    run are reparsed and validated, and if nothing changed the topics file
+    isn't rewritten at all. Either way, return the ids of the topics that
+    changed (they're also recorded in the manifest next to final_filepath).
+
+    In streaming mode, worksheets are parsed as they download. With fields,
+    resources only keep those columns plus the ones the pipeline needs.
+
+    Worksheets not downloaded within timeout seconds fall back to their
+    cached copies, and are flagged as stale in the output.
+
+    """
+    deadline = time.time() + timeout
+    topics, hashes = load_manifest(final_filepath) if incremental else ({}, {})
+    topics, hashes, changed = update_topics(worksheets_for(source), topics, hashes, stream=stream,
+                                            fields=fields, deadline=deadline)
+    save(topics, hashes, changed, staging_filepath, final_filepath)
+    report(topics, changed)
+    return changed
+
+
+def report(topics, changed):
+    stale = sorted(topic_id for topic_id, topic in topics.items() if topic.get('stale'))
+    print("Changed topics: {}".format(', '.join(changed) if changed else '(none)'))
+    if stale:
+        print("Stale topics: {}".format(', '.join(stale)))
+
+
+def worksheets_for(source):
+    """Return [(title, url)] for a Google Sheets key or a source from sources.py.
+    """
+    if hasattr(source, 'worksheets'):
+        return source.worksheets()
+    return fetch_worksheets(source)
+
+
+def save(topics, hashes, changed, staging_filepath, final_filepath):
+    """Write topics, their snapshot, and the manifest (skipping topics if nothing changed).
+    """
+    final_snapshot = snapshot_path(final_filepath)
+    if changed or not os.path.exists(final_filepath) or not os.path.exists(final_snapshot):
+        staging_snapshot = snapshot_path(staging_filepath)
+        dump_topics(topics, staging_filepath, staging_snapshot)
+        shutil.move(staging_filepath, final_filepath)
+        shutil.move(staging_snapshot, final_snapshot)
+    stale = sorted(topic_id for topic_id, topic in topics.items() if topic.get('stale'))
+    dump_manifest(hashes, changed, stale, final_filepath)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Fetch data for the CaaC map.')
+    parser.add_argument('--incremental', '-i', action='store_true',
+                        help='only rebuild topics whose worksheet has changed')
+    parser.add_argument('--stream', '-s', action='store_true',
+                        help='parse worksheets as they download')
+    parser.add_argument('--fields', '-f', type=lambda s: s.split(','),
+                        help='comma-separated display fields to keep (default: all)')
+    parser.add_argument('--from-directory', '-d', metavar='DIRECTORY',
+                        help='replay worksheets recorded with sources.py instead')
+    parser.add_argument('--timeout', '-t', default=REFRESH_TIMEOUT, type=float,
+                        help='seconds to wait before falling back to cached worksheets')
+    args = parser.parse_args()
+
+    source = SHEETS_KEY
+    if args.from_directory:
+        import sources
+        source = sources.Directory(args.from_directory)
     staging = os.path.join('output', '.topics.json')
     final = os.path.join('output', 'topics.json')
 
-    main(sheets_key, staging, final)
+    main(source, staging, final, incremental=args.incremental, stream=args.stream,
+         fields=args.fields, timeout=args.timeout)
@@ -2,13 +2,30 @@
 import io
 import random
 import sys
+import time
 import traceback
 import itertools as it
 import uuid
 from math import ceil, sqrt, factorial
 import pickle
 
+import metrics
 import pathways_solver
+from deadlines import DeadlineExceeded
+
+
+# The solver relaxes its no-crossings rule as it goes, giving up on it entirely
+# after this many nodes, which bounds how long assign_ids can take.
+RELAX_CROSSINGS_UNTIL = 1e8
+
+# What estimate charges, calibrated on renders of output/topics.json. With
+# take_first, the solver visits something like 1e5 nodes per topic (7e3 to 7e5,
+# depending on luck more than on resources) once a topic has more than a
+# handful of resources, and a node takes about as long as three canvas cells
+# take to lay out. A unit of cost takes about SECONDS_PER_COST on one core.
+SOLVER_NODES_PER_TOPIC = 1e5
+CELLS_PER_SOLVER_NODE = 3
+SECONDS_PER_COST = 1.5e-5
 
 
 class NoPossibleShapes(Exception): pass
@@ -362,13 +379,14 @@ class MagnitudeMap(list):
         return unsnapped
 
 
-    def assign_ids(self, pathways, take_first=True):
+    def assign_ids(self, pathways, take_first=True, deadline=None):
         """Given a pathways data structure, assign resources to shapes.
         """
         solutions = pathways_solver.solve( self.shapes
                                          , pathways
                                          , take_first
-                                         , relax_crossings_until=1e8
+                                         , relax_crossings_until=RELAX_CROSSINGS_UNTIL
+                                         , deadline=deadline
                                           )
         self.assignments = dict(pathways_solver.flatten(random.choice(solutions)))
         assert len(set(self.assignments.values())) == len(self.assignments)
@@ -389,7 +407,8 @@ def err(*a, **kw):
     print(file=sys.stderr, *a, **kw)
 
 
-def generate_map(topics, charset='utf8', width=1024, height=1024, alley_width=6, building_min=10):
+def generate_map(topics, charset='utf8', width=1024, height=1024, alley_width=6, building_min=10,
+        deadline=None):
     charset = charsets[charset]
     canvas_size = (width, height)
     street_width = alley_width * 10
@@ -402,6 +421,7 @@ def generate_map(topics, charset='utf8', width=1024, height=1024, alley_width=6,
                   , street_width
                   , building_min
                   , monkeys=False
+                  , deadline=deadline
                   , aspect_min=0.5
                    )
     print(big.to_svg(), file=open('output/big.svg', 'w+'))  # for debugging
@@ -425,11 +445,64 @@ def generate_map(topics, charset='utf8', width=1024, height=1024, alley_width=6,
                                          , building_min
                                          , aspect_min=0.2
                                          , monkeys=True
+                                         , deadline=deadline
                                           )))
     return big, blocks
 
 
-def output_svg(topics, fp, big, blocks):
+def estimate(topics, charset='utf8', width=1024, height=1024, alley_width=6, building_min=10):
+    """Estimate what generate_map will take, without generating anything.
+
+    Return a dict with the number of resources, the canvas cells that
+    fill_one will lay out, the solver nodes that assign_ids will likely visit
+    (per count_nodes for small topics, and SOLVER_NODES_PER_TOPIC for the
+    rest), a cost that weighs the two (in cells), and whether the map can fit
+    at all.
+
+    Fitting works the way MagnitudeMap.determine_target_area does: each
+    topic gets a share of the canvas in proportion to its subtopics, and each
+    resource a share of its topic's block, and no share may be smaller than
+    shape_min ** 2. Blocks are assumed square, and since resources get
+    random magnitudes, the smallest share is at most the average, so if the
+    average is too small the map can never fit.
+
+    """
+    width, height, alley_width, building_min = map(int, (width, height, alley_width, building_min))
+    street_width = alley_width * 10
+    offset = street_width - alley_width
+    out = {'resources': 0, 'cells': width * height, 'solver_nodes': 0, 'problem': None}
+
+    nsubtopics = {topic_id: len(topic['subtopics']) for topic_id, topic in topics.items()}
+    total = sum(nsubtopics.values())
+    usable = (width - street_width) * (height - street_width)
+    for topic_id, topic in topics.items():
+        n = sum(len(subtopic['resources']) for subtopic in topic['subtopics'].values())
+        out['resources'] += n
+        share = max(usable, 0) * nsubtopics[topic_id] / total if total else 0
+        block = max(int(sqrt(share)) - offset, 0)
+        out['cells'] += block ** 2
+        out['solver_nodes'] += min(pathways_solver.count_nodes(min(n, 10)), SOLVER_NODES_PER_TOPIC)
+        if out['problem']:
+            continue
+        if not n:
+            out['problem'] = 'topic {} has no resources'.format(topic_id)
+        elif share < (building_min + street_width) ** 2:
+            out['problem'] = 'the canvas is too small for topic {}'.format(topic_id)
+        elif (block - alley_width) ** 2 / n < (building_min + alley_width) ** 2:
+            out['problem'] = 'the block for topic {} is too small for its {} resources' \
+                             .format(topic_id, n)
+    if not topics:
+        out['problem'] = 'there are no topics'
+
+    out['solver_nodes'] = int(out['solver_nodes'])
+    out['cost'] = out['cells'] + CELLS_PER_SOLVER_NODE * out['solver_nodes']
+    out['feasible'] = out['problem'] is None
+    return out
+
+
+def output_svg(topics, fp, big, blocks, deadline=None):
+    start = time.time()
+    assigning = 0
     half_W = big.W / 2
     half_H = big.H / 2
     rotated_side = lambda x: int(ceil(sqrt((x ** 2) / 2)))
@@ -447,17 +520,26 @@ def output_svg(topics, fp, big, blocks):
         x, y, shape = big.shapes[uid]
         subtopics = topics[uid]['subtopics'].values()
         pathways = {s['id']: s['dag']['names'] for s in subtopics}
-        block.assign_ids(pathways)
+        t = time.time()
+        block.assign_ids(pathways, deadline=deadline)
+        t = time.time() - t
+        metrics.observe('caac_assign_ids_seconds', t)
+        assigning += t
         print(block.to_svg(uid, x + offset, y + offset), file=fp)
 
     print('  </g>', file=fp)
     print('</svg>', file=fp)
+    metrics.observe('caac_svg_render_seconds', time.time() - start - assigning)
 
 
-def fill_one(charset, name, canvas_size, magnitudes, alley_width, building_min, monkeys, **kw):
+def fill_one(charset, name, canvas_size, magnitudes, alley_width, building_min, monkeys,
+        deadline=None, **kw):
     i = 0
+    start = time.time()
     mfunc = (lambda m: random.randint(3, 10)) if monkeys else (lambda m: m)
     while 1:
+        if deadline is not None:
+            deadline.check()
         i += 1
         err('Iteration:', i)
 
@@ -471,9 +553,13 @@ def fill_one(charset, name, canvas_size, magnitudes, alley_width, building_min,
                          alley_width=alley_width, building_min=building_min, **kw)
         try:
             for uid, magnitude in magnitudes:
+                if deadline is not None:
+                    deadline.check()
                 m.add(magnitude, uid=uid)
                 nplaced += 1
                 nremaining -= 1
+        except DeadlineExceeded:
+            raise
         except:
             tb = traceback.format_exc()
         else:
@@ -497,6 +583,8 @@ def fill_one(charset, name, canvas_size, magnitudes, alley_width, building_min,
 
         if nremaining == 0 and m.remaining_area == 0:
             break
+    metrics.observe('caac_fill_one_seconds', time.time() - start)
+    metrics.observe('caac_fill_one_iterations', i)
     return m
 
 
@@ -527,7 +615,8 @@ if __name__ == '__main__':
     import argparse, json
 
     parser = argparse.ArgumentParser(description='Generate a CaaC map.')
-    parser.add_argument('input', help='the name of an input file in json format, or - for stdin')
+    parser.add_argument('input', help='the name of an input file in json format (or a .snapshot '
+                                      'from fetch.py), or - for stdin')
     parser.add_argument('output', help='the name of an output file, or - for stdout')
     parser.add_argument('--charset', '-c', default='utf8', help='the character set to use',
                         choices=sorted(charsets.keys()))
@@ -537,7 +626,11 @@ if __name__ == '__main__':
     parser.add_argument('--building_min', '-b', default=10, type=int,
                         help='the minimum width of the blocks')
     args = parser.parse_args()
-    topics = json.load(sys.stdin if args.input == '-' else open(args.input, 'r'))
+    if args.input.endswith('.snapshot'):
+        import snapshot
+        topics = snapshot.load(args.input)
+    else:
+        topics = json.load(sys.stdin if args.input == '-' else open(args.input, 'r'))
     fp = sys.stdout if args.output == '-' else open(args.output, 'w+')
     args.__dict__.pop('input')
     args.__dict__.pop('output')
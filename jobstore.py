@@ -0,0 +1,311 @@
+"""A job queue and result store in SQLite, shared by server processes and runners.
+
+Without one, jobs live in the memory of whichever gunicorn worker received
+them. With one (set CAAC_JOB_STORE to a database path), every worker puts
+jobs here and looks them up here, and separate runner processes (runner.py)
+claim and run them. Claims are leases: a runner that dies mid-job stops
+renewing its lease, and once the lease runs out the job goes to another
+runner. Queued jobs survive restarts of everything.
+
+Moving averages live here too, so that how long runners find jobs take can
+inform how web processes rank them.
+
+A job identical to one that's queued or running follows it instead of
+queueing: it has no request of its own, doesn't count against the queue, and
+is finished by whichever runner finishes its leader.
+
+Rendered SVGs go in a directory next to the database, so any process can
+serve them.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS jobs
+        ( id            TEXT PRIMARY KEY
+        , key           TEXT NOT NULL
+        , lane          TEXT NOT NULL
+        , rank          REAL NOT NULL  -- lower runs sooner
+        , status        TEXT NOT NULL
+        , callback_url  TEXT
+        , request       TEXT           -- JSON [topics, kwargs], until the job has run
+        , estimate      TEXT NOT NULL  -- JSON
+        , callback      TEXT NOT NULL  -- JSON
+        , error         TEXT
+        , svg_path      TEXT
+        , submitted_at  REAL NOT NULL
+        , started_at    REAL
+        , finished_at   REAL
+        , runner        TEXT
+        , lease_until   REAL
+        , attempts      INTEGER NOT NULL DEFAULT 0
+        , leader        TEXT           -- the id of the identical job this one follows, if any
+         );
+    CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, lane, rank);
+    CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished_at);
+    CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key);
+    CREATE INDEX IF NOT EXISTS jobs_leader ON jobs (leader);
+    CREATE TABLE IF NOT EXISTS averages
+        ( name          TEXT PRIMARY KEY
+        , value         REAL NOT NULL
+         );
+'''
+
+FINISHED = ('done', 'failed', 'timed out')
+
+
+class JobStore(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.svg_dir = os.path.splitext(path)[0] + '-svg'
+        os.makedirs(self.svg_dir, exist_ok=True)
+        self.local = threading.local()
+        self.connect().executescript(SCHEMA)
+
+    def connect(self):
+        """Return this thread's connection, opening it if need be.
+        """
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute('PRAGMA journal_mode=WAL')
+            self.local.db = db
+        return db
+
+    def transaction(self):
+        return _Transaction(self.connect())
+
+    # Queueing
+    # ========
+
+    def put(self, job, rank, depth):
+        """Queue job in its lane, unless depth jobs are queued there already. Return whether we did.
+
+        If an identical job is queued or running, job follows it instead,
+        which always succeeds.
+
+        """
+        with self.transaction() as db:
+            leader = db.execute( "SELECT id FROM jobs WHERE key=? AND request IS NOT NULL AND "
+                                 "status IN ('queued', 'running') ORDER BY submitted_at LIMIT 1"
+                               , (job.key,)
+                                ).fetchone()
+            if leader is not None:
+                self._insert(db, job, rank, None, leader[0])
+                return True
+            nqueued = db.execute( "SELECT count(*) FROM jobs WHERE status='queued' AND lane=? "
+                                  "AND leader IS NULL"
+                                , (job.lane,)
+                                 ).fetchone()[0]
+            if nqueued >= depth:
+                return False
+            self._insert(db, job, rank, [job.topics, job.kwargs])
+        return True
+
+    def add(self, job):
+        """Store a job that this process is running, or has finished, so runners leave it alone.
+        """
+        with self.transaction() as db:
+            self._insert(db, job, 0, None)
+
+    def _insert(self, db, job, rank, request, leader=None):
+        db.execute( 'INSERT INTO jobs (id, key, lane, rank, status, callback_url, request, estimate, '
+                    'callback, error, svg_path, submitted_at, started_at, finished_at, leader) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+                  , ( job.id, job.key, job.lane, rank, job.status, job.callback_url
+                    , None if request is None else json.dumps(request)
+                    , json.dumps(job.estimate), json.dumps(job.callback), job.error, job.svg_path
+                    , job.submitted_at, job.started_at, job.finished_at, leader
+                     )
+                   )
+
+    def claim(self, runner, lease, lanes, max_attempts=None):
+        """Lease the next job to run in lanes to runner for lease seconds, and return its row.
+
+        Jobs whose runner's lease has run out are fair game, unless runners
+        have claimed them max_attempts times already: those probably take
+        their runners down with them, so we mark them failed instead. Return
+        None if there's nothing to run.
+
+        """
+        now = time.time()
+        marks = ','.join('?' * len(lanes))
+        with self.transaction() as db:
+            if max_attempts is not None:
+                doomed = "SELECT id FROM jobs WHERE status='running' AND request IS NOT NULL AND " \
+                         "lease_until < ? AND attempts >= ?"
+                db.execute( "UPDATE jobs SET status='failed', error=?, finished_at=?, request=NULL "
+                            "WHERE id IN ({0}) OR leader IN ({0})".format(doomed)
+                          , ( 'Gave up after {} attempts, none of which finished.'.format(max_attempts)
+                            , now, now, max_attempts, now, max_attempts
+                             )
+                           )
+            row = db.execute( 'SELECT * FROM jobs WHERE lane IN ({}) AND request IS NOT NULL AND '
+                              '(status=? OR (status=? AND lease_until < ?)) '
+                              'ORDER BY rank LIMIT 1'.format(marks)
+                            , tuple(lanes) + ('queued', 'running', now)
+                             ).fetchone()
+            if row is None:
+                return None
+            db.execute( 'UPDATE jobs SET status=?, runner=?, lease_until=?, started_at=?, '
+                        'attempts=attempts+1 WHERE id=?'
+                      , ('running', runner, now + lease, now, row['id'])
+                       )
+        return self._decode(row)
+
+    def renew(self, job_id, runner, lease):
+        """Extend runner's lease on a job. Return False if it isn't runner's any more.
+        """
+        with self.transaction() as db:
+            cursor = db.execute( "UPDATE jobs SET lease_until=? "
+                                 "WHERE id=? AND runner=? AND status='running'"
+                               , (time.time() + lease, job_id, runner)
+                                )
+            return cursor.rowcount == 1
+
+    def save(self, job):
+        """Store job's progress, unless another runner has taken it over. Return whether we did.
+
+        Once job is finished, so are the jobs following it, in the same
+        transaction: a runner dying in between can't leave them waiting on
+        a leader that will never run again.
+
+        """
+        finished = job.status in FINISHED
+        with self.transaction() as db:
+            cursor = db.execute( 'UPDATE jobs SET status=?, error=?, svg_path=?, callback=?, '
+                                 'started_at=?, finished_at=?, '
+                                 'request=CASE WHEN ? THEN NULL ELSE request END '
+                                 'WHERE id=? AND runner IS ?'
+                               , ( job.status, job.error, job.svg_path, json.dumps(job.callback)
+                                 , job.started_at, job.finished_at, finished, job.id, job.runner
+                                  )
+                                )
+            if cursor.rowcount != 1:
+                return False
+            if finished:
+                db.execute( 'UPDATE jobs SET status=?, error=?, svg_path=?, started_at=?, finished_at=?, '
+                            'request=NULL WHERE leader=? AND finished_at IS NULL'
+                          , ( job.status, job.error, job.svg_path, job.started_at, job.finished_at
+                            , job.id
+                             )
+                           )
+            return True
+
+    # Looking Up
+    # ==========
+
+    def get(self, job_id):
+        row = self.connect().execute('SELECT * FROM jobs WHERE id=?', (job_id,)).fetchone()
+        return None if row is None else self._decode(row)
+
+    def followers(self, job_id):
+        """Return the rows of jobs following the job with job_id.
+        """
+        rows = self.connect().execute('SELECT * FROM jobs WHERE leader=?', (job_id,)).fetchall()
+        return [self._decode(row) for row in rows]
+
+    def undelivered(self):
+        """Return the rows of jobs done whose callbacks are neither delivered nor given up on.
+        """
+        rows = self.connect().execute( "SELECT * FROM jobs WHERE status='done' "
+                                       "AND callback_url IS NOT NULL"
+                                      ).fetchall()
+        rows = [self._decode(row) for row in rows]
+        return [row for row in rows if row['callback']['status'] == 'pending']
+
+    def rendered(self, key, ttl):
+        """Return the SVG path of the latest job done for key in the last ttl seconds, or None.
+        """
+        row = self.connect().execute( "SELECT svg_path FROM jobs WHERE key=? AND status='done' "
+                                      "AND svg_path IS NOT NULL AND finished_at >= ? "
+                                      "ORDER BY finished_at DESC LIMIT 1"
+                                    , (key, time.time() - ttl)
+                                     ).fetchone()
+        return None if row is None else row[0]
+
+    def position(self, row):
+        """Return how many jobs are ahead of row's in line, or None if it isn't queued.
+        """
+        if row['status'] != 'queued':
+            return None
+        return self.connect().execute( "SELECT count(*) FROM jobs WHERE status='queued' AND lane=? "
+                                       "AND rank < ? AND leader IS NULL"
+                                     , (row['lane'], row['rank'])
+                                      ).fetchone()[0]
+
+    def count(self, status, lane=None):
+        """Return how many jobs have status (in lane), not counting followers.
+        """
+        sql, args = 'SELECT count(*) FROM jobs WHERE status=? AND leader IS NULL', (status,)
+        if lane is not None:
+            sql, args = sql + ' AND lane=?', args + (lane,)
+        return self.connect().execute(sql, args).fetchone()[0]
+
+    def expire(self, ttl):
+        """Forget jobs that finished more than ttl seconds ago, and remove their SVGs.
+        """
+        cutoff = time.time() - ttl
+        with self.transaction() as db:
+            paths = [row[0] for row in db.execute( 'SELECT svg_path FROM jobs WHERE finished_at < ?'
+                                                 , (cutoff,)
+                                                  )]
+            db.execute('DELETE FROM jobs WHERE finished_at < ?', (cutoff,))
+        for path in paths:
+            if path and os.path.dirname(path) == self.svg_dir:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    # Averages
+    # ========
+
+    def average(self, name, value, alpha, initial=None):
+        """Move the average called name (initial, or else value, if it's new) alpha of the way to value.
+        """
+        with self.transaction() as db:
+            row = db.execute('SELECT value FROM averages WHERE name=?', (name,)).fetchone()
+            average = initial if row is None else row[0]
+            average = value if average is None else average + alpha * (value - average)
+            db.execute('INSERT OR REPLACE INTO averages (name, value) VALUES (?, ?)', (name, average))
+
+    def averages(self, *names):
+        """Return a dict of the averages called names, leaving out any that are new.
+        """
+        rows = self.connect().execute( 'SELECT name, value FROM averages WHERE name IN ({})'
+                                       .format(','.join('?' * len(names)))
+                                     , names
+                                      )
+        return dict(rows.fetchall())
+
+    def _decode(self, row):
+        row = dict(row)
+        for name in ('request', 'estimate', 'callback'):
+            if row[name] is not None:
+                row[name] = json.loads(row[name])
+        return row
+
+
+class _Transaction(object):
+    """Run a block in an immediate transaction, so that reads and writes in it are atomic.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute('BEGIN IMMEDIATE')
+        return self.db
+
+    def __exit__(self, cls, exc, tb):
+        self.db.execute('COMMIT' if cls is None else 'ROLLBACK')
@@ -0,0 +1,182 @@
+"""Counters, gauges and histograms for the map service, in Prometheus' text format.
+
+Instrumented code calls observe (or uses timer), which is a dict lookup and
+an addition or two, cheap enough to leave on everywhere. Map generation
+runs in pool processes, where observations would land in the wrong
+process's metrics, so server.render captures them in a list instead, and
+the server replays them once the render comes back. With a job store, jobs
+run in runner.py processes instead, and each runner serves its own metrics.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+
+REGISTRY = {}
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_local = threading.local()
+
+
+def _format_labels(labels, **extra):
+    pairs = list(labels) + sorted(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in pairs) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric(object):
+
+    kind = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        REGISTRY[name] = self
+
+    def header(self):
+        return ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.kind)]
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        super(Counter, self).__init__(name, help)
+        self.values = {}
+
+    def record(self, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def get(self, **labels):
+        return self.values.get(tuple(sorted(labels.items())), 0)
+
+    def render(self):
+        lines = self.header()
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append('{}{} {}'.format(self.name, _format_labels(key), _format_value(value)))
+        return lines
+
+
+class Gauge(Metric):
+    """A value read from function whenever metrics are rendered.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, function):
+        super(Gauge, self).__init__(name, help)
+        self.function = function
+
+    def render(self):
+        return self.header() + ['{} {}'.format(self.name, _format_value(self.function()))]
+
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=TIME_BUCKETS):
+        super(Histogram, self).__init__(name, help)
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last is for +Inf
+        self.sum = 0
+        self.count = 0
+
+    def record(self, value):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def render(self):
+        lines = self.header()
+        with self.lock:
+            cumulative = 0
+            for le, count in zip(self.buckets + ('+Inf',), self.counts):
+                cumulative += count
+                le = le if le == '+Inf' else _format_value(le)
+                lines.append('{}_bucket{} {}'.format(self.name, _format_labels((), le=le), cumulative))
+            lines.append('{}_sum {}'.format(self.name, _format_value(self.sum)))
+            lines.append('{}_count {}'.format(self.name, self.count))
+        return lines
+
+
+# Recording
+# =========
+
+def observe(name, value=1, **labels):
+    """Record value for the metric called name, or capture it if we're capturing.
+    """
+    captured = getattr(_local, 'captured', None)
+    if captured is not None:
+        captured.append((name, value, labels))
+    else:
+        REGISTRY[name].record(value, **labels)
+
+
+@contextmanager
+def timer(name):
+    """Observe the seconds the block takes.
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        observe(name, time.time() - start)
+
+
+@contextmanager
+def capture():
+    """Yield a list that this thread's observations go into, instead of into metrics.
+    """
+    saved = getattr(_local, 'captured', None)
+    _local.captured = captured = []
+    try:
+        yield captured
+    finally:
+        _local.captured = saved
+
+
+def replay(captured):
+    """Record observations from capture (in this process or another).
+    """
+    for name, value, labels in captured:
+        observe(name, value, **labels)
+
+
+def render():
+    lines = []
+    for name in sorted(REGISTRY):
+        lines.extend(REGISTRY[name].render())
+    return '\n'.join(lines) + '\n'
+
+
+# Metrics
+# =======
+
+Histogram('caac_fill_one_seconds', 'Seconds spent laying out a canvas with fill_one.')
+Histogram('caac_fill_one_iterations', 'Attempts fill_one took to lay out a canvas.',
+          (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+Histogram('caac_assign_ids_seconds', 'Seconds spent assigning resources to shapes.')
+Histogram('caac_solver_nodes', 'Nodes the pathways solver visited per problem.',
+          (10, 100, 1000, 10000, 100000, 1000000, 10000000))
+Histogram('caac_svg_render_seconds', 'Seconds spent writing SVG, not counting assigning ids.')
+Histogram('caac_job_seconds', 'Seconds from starting a job to having its SVG.')
+Histogram('caac_callback_seconds', 'Seconds from finishing a job to delivering its callback.')
+Counter('caac_cache_requests_total', 'Map requests looked up in the SVG cache, by result.')
+Counter('caac_callbacks_total', 'Callback delivery attempts, by outcome.')
@@ -6,6 +6,7 @@ from functools import reduce
 from math import inf
 from operator import mul
 
+import metrics
 from geometry import Point, Segment
 
 
@@ -37,6 +38,8 @@ square = lambda x: x ** 2
 def count_possible_solutions(level):
     return reduce(mul, map(square, range(1, level)), 1)
 
+CHECK_DEADLINE_EVERY = 1000  # nodes
+
 def count_nodes(level):
     return 1 + sum(reduce(mul, map(square, range(v, level)), 1) for v in range(1, level))
 
@@ -51,7 +54,7 @@ class Problem(object):
     latest_pathway_assignment = None
 
     def __init__(self, shapes, pathways, take_first=False, relax_assignments_until=inf,
-            relax_crossings_until=inf):
+            relax_crossings_until=inf, deadline=None):
         """Instantiate a pathways assignment problem.
 
         The problem definition is given in a shapes dictionary, mapping shape
@@ -74,6 +77,7 @@ class Problem(object):
         self.take_first = take_first    # whether to raise after the first solution is found
         self.relax_assignments_until = relax_assignments_until
         self.relax_crossings_until = relax_crossings_until
+        self.deadline = deadline        # a deadlines.Deadline to check as we go, or None
         self.resources = flatten(pathways)
 
         nlevels = len(self.shapes)
@@ -125,13 +129,16 @@ class Problem(object):
 
 
 def solve(shapes, pathways, take_first=False, relax_assignments_until=inf,
-        relax_crossings_until=inf):
-    problem = Problem(shapes, pathways, take_first, relax_assignments_until, relax_crossings_until)
+        relax_crossings_until=inf, deadline=None):
+    problem = Problem(shapes, pathways, take_first, relax_assignments_until, relax_crossings_until,
+                      deadline)
     try:
         backtrack(problem, root(problem))
     except FirstSolutionFound as exc:
         solution = exc.args[0]
         return [solution]
+    finally:
+        metrics.observe('caac_solver_nodes', problem.stats['ncalls'])
 
     if not problem.solutions:
         raise NoSolutionFound()
@@ -294,6 +301,8 @@ def clean_up(P, c):
 def backtrack(P, c):
     P.depth += 1
     P.stats['ncalls'] += 1
+    if P.deadline is not None and P.stats['ncalls'] % CHECK_DEADLINE_EVERY == 0:
+        P.deadline.check()
     if P.stats['ncalls'] % 10000 == 0:
         print('{depth} / {nlevels} | '
               '{ncalls} / {nnodes:.1e} | '
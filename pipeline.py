@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""Fetch data for the CaaC map and render it, all in one process.
+
+This is fetch.py followed by genmap.py, minus the round trip through
+topics.json in between: topics are fetched, validated, and turned into DAGs,
+and then handed straight to generate_map and output_svg. topics.json (and its
+snapshot and manifest) are still written, for the record, but from a
+background thread while the map is being generated.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import sys
+import threading
+import time
+
+import fetch
+import genmap
+
+
+def main(source, fp, staging_filepath, final_filepath, incremental=False, stream=False,
+        fields=None, timeout=fetch.REFRESH_TIMEOUT, **kw):
+    """Fetch topics from source and write a map of them to fp.
+
+    Keyword arguments beyond the fetch ones are passed through to
+    genmap.generate_map. Return the ids of the topics that changed.
+
+    """
+    deadline = time.time() + timeout
+    topics, hashes = fetch.load_manifest(final_filepath) if incremental else ({}, {})
+    topics, hashes, changed = fetch.update_topics(fetch.worksheets_for(source), topics, hashes,
+                                                  stream=stream, fields=fields, deadline=deadline)
+    fetch.report(topics, changed)
+
+    archiver = threading.Thread( target=fetch.save
+                               , args=(topics, hashes, changed, staging_filepath, final_filepath)
+                                )
+    archiver.start()
+    try:
+        big, blocks = genmap.generate_map(topics, **kw)
+        genmap.output_svg(topics, fp, big, blocks)
+    finally:
+        archiver.join()
+    return changed
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Fetch data for and generate a CaaC map.')
+    parser.add_argument('output', help='the name of an output file, or - for stdout')
+    parser.add_argument('--charset', '-c', default='utf8', help='the character set to use',
+                        choices=sorted(genmap.charsets.keys()))
+    parser.add_argument('--width', '-W', default=128, type=int, help='the width of the canvas')
+    parser.add_argument('--height', '-H', default=128, type=int, help='the height of the canvas')
+    parser.add_argument('--alley_width', '-a', default=6, type=int, help='the width of the alleys')
+    parser.add_argument('--building_min', '-b', default=10, type=int,
+                        help='the minimum width of the blocks')
+    parser.add_argument('--incremental', '-i', action='store_true',
+                        help='only rebuild topics whose worksheet has changed')
+    parser.add_argument('--stream', '-s', action='store_true',
+                        help='parse worksheets as they download')
+    parser.add_argument('--fields', '-f', type=lambda s: s.split(','),
+                        help='comma-separated display fields to keep (default: all)')
+    parser.add_argument('--from-directory', '-d', metavar='DIRECTORY',
+                        help='replay worksheets recorded with sources.py instead')
+    parser.add_argument('--timeout', '-t', default=fetch.REFRESH_TIMEOUT, type=float,
+                        help='seconds to wait before falling back to cached worksheets')
+    args = parser.parse_args()
+
+    source = fetch.SHEETS_KEY
+    if args.from_directory:
+        import sources
+        source = sources.Directory(args.from_directory)
+    staging = os.path.join('output', '.topics.json')
+    final = os.path.join('output', 'topics.json')
+    fp = sys.stdout if args.output == '-' else open(args.output, 'w+')
+
+    main( source, fp, staging, final
+        , incremental=args.incremental
+        , stream=args.stream
+        , fields=args.fields
+        , timeout=args.timeout
+        , charset=args.charset
+        , width=args.width
+        , height=args.height
+        , alley_width=args.alley_width
+        , building_min=args.building_min
+         )
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+"""Run map jobs from the job store that server.py queues them in.
+
+Run as many of these as you like alongside the web processes, all with
+CAAC_JOB_STORE pointing at the same database; each runs one job at a time,
+in-process, so throughput scales with the number of runners. While a runner
+works on a job it keeps renewing its lease, so if it dies the job goes to
+another runner once the lease runs out. Between jobs, runners also forget
+jobs that finished more than CAAC_JOB_TTL seconds ago.
+
+Callbacks waiting to be delivered or retried only live in the memory of the
+process that queued them, so each runner starts by queueing the callbacks of
+done jobs that are still pending. Receivers should expect the odd callback
+twice, when another process was still working on it.
+
+Runners keep no SVGs in memory, since nothing would ever ask them for one: the
+web processes answer repeat requests from jobs done in the store (and from
+CAAC_CACHE_DIR, if the runners share it with them).
+
+Metrics about rendering (caac_job_seconds, caac_fill_one_seconds and the
+like) are recorded where jobs run, which is here, so the web processes'
+/metrics leaves them out. Give a runner --metrics-port (or CAAC_METRICS_PORT)
+to serve its own at /metrics, for Prometheus to scrape alongside theirs.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import socket
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import metrics
+import server
+from cache import LRUCache
+
+
+LEASE = float(os.environ.get('CAAC_LEASE', 60))  # seconds
+POLL = float(os.environ.get('CAAC_POLL', 1))     # seconds to wait when there's nothing to do
+MAX_ATTEMPTS = int(os.environ.get('CAAC_MAX_ATTEMPTS', 3))  # claims before a job is failed
+EXPIRE_EVERY = float(os.environ.get('CAAC_EXPIRE_EVERY', 60))  # seconds between expiring old jobs
+METRICS_PORT = int(os.environ.get('CAAC_METRICS_PORT', 0))     # where to serve metrics, or 0
+
+
+def job_from_row(row, runner):
+    topics, kwargs = row['request']
+    job = server.Job(row['callback_url'], topics, kwargs)
+    job.id = row['id']
+    job.submitted_at = row['submitted_at']
+    job.started_at = row['started_at']
+    job.runner = runner
+    return job
+
+
+def finished_job_from_row(row):
+    """Return a job for a finished row, with enough of it to deliver its callback and save how that went.
+    """
+    job = server.Job.__new__(server.Job)  # its request is gone, so there's nothing to estimate
+    for name in ( 'id', 'key', 'callback_url', 'callback', 'estimate', 'status', 'error', 'svg_path'
+                , 'submitted_at', 'started_at', 'finished_at', 'runner'
+                 ):
+        setattr(job, name, row[name])
+    job.topics, job.leader, job.followers = None, None, []
+    return job
+
+
+def resume_callbacks(store):
+    """Queue callbacks that jobs done before we started never got to deliver. Return how many.
+    """
+    rows = store.undelivered()
+    for row in rows:
+        server.delivery.submit(finished_job_from_row(row))
+    return len(rows)
+
+
+def keep_leased(store, job, runner, lease, done):
+    """Renew our lease on job until done is set, or until we lose it, and then stop the job.
+    """
+    while not done.wait(lease / 3):
+        if not store.renew(job.id, runner, lease):
+            print("Lost our lease on job {}. Stopping it.".format(job.id))
+            job.deadline.cancel()
+            return
+
+
+def run_one(store, runner, lease=LEASE, lanes=('fast', 'slow'), max_attempts=MAX_ATTEMPTS):
+    """Claim and run the next job. Return False if there wasn't one.
+    """
+    row = store.claim(runner, lease, lanes, max_attempts)
+    if row is None:
+        return False
+    job = job_from_row(row, runner)
+    done = threading.Event()
+    renewer = threading.Thread(target=keep_leased, args=(store, job, runner, lease, done))
+    renewer.daemon = True
+    renewer.start()
+    try:
+        job.run()
+    except Exception:
+        traceback.print_exc()
+    finally:
+        done.set()
+    return True
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *a):
+        pass  # scrapes every few seconds would drown out our own output
+
+
+def serve_metrics(port):
+    """Serve our metrics at /metrics on port, from a background thread, and return the server.
+    """
+    httpd = HTTPServer(('', port), MetricsHandler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return httpd
+
+
+def main(lease=LEASE, poll=POLL, lanes=('fast', 'slow'), metrics_port=METRICS_PORT):
+    if server.store is None:
+        raise SystemExit("Set CAAC_JOB_STORE to the job store's database path.")
+    server.PROCESSES = 0  # we're the process
+    server.svg_cache.memory = LRUCache(0)  # web processes find our SVGs through the store
+    if metrics_port:
+        serve_metrics(metrics_port)
+    runner = '{}:{}'.format(socket.gethostname(), os.getpid())
+    resume_callbacks(server.store)
+    expired_at = 0
+    while 1:
+        if time.time() - expired_at >= EXPIRE_EVERY:
+            server.store.expire(server.JOB_TTL)
+            expired_at = time.time()
+        if not run_one(server.store, runner, lease, lanes):
+            time.sleep(poll)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run CaaC map jobs from the job store.')
+    parser.add_argument('--lanes', '-l', default='fast,slow', type=lambda s: tuple(s.split(',')),
+                        help='comma-separated lanes to take jobs from (fast, slow)')
+    parser.add_argument('--lease', default=LEASE, type=float, help='seconds to lease jobs for')
+    parser.add_argument('--poll', default=POLL, type=float,
+                        help='seconds to wait when there are no jobs')
+    parser.add_argument('--metrics-port', default=METRICS_PORT, type=int,
+                        help='a port to serve metrics on at /metrics (default: none)')
+    args = parser.parse_args()
+    main(args.lease, args.poll, args.lanes, args.metrics_port)
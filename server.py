@@ -1,30 +1,699 @@
 #!/usr/bin/env python
 import os
 import io
+import copy
+import json
 import genmap
+import heapq
+import hashlib
+import inspect
+import itertools
+import tempfile
 import threading
+import time
+import traceback
+import uuid
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from math import inf
 
 import requests
 import flask
 
+import metrics
+from cache import DiskCache, LRUCache
+from deadlines import Deadline, DeadlineExceeded
+from jobstore import JobStore
+
 DEV = bool(os.environ.get('FLASK_DEBUG', False))
 
+# Map generation is CPU-bound pure Python, so it runs in a pool of processes,
+# one per core by default (0 means run it in the worker thread instead). We run
+# that many jobs at a time, and queue up a limited number more. Beyond that we
+# turn requests away.
+PROCESSES = int(os.environ.get('CAAC_PROCESSES', os.cpu_count() or 1))
+WORKERS = int(os.environ.get('CAAC_WORKERS', PROCESSES or 2))
+QUEUE_DEPTH = int(os.environ.get('CAAC_QUEUE_DEPTH', 16))
+RETRY_AFTER = int(os.environ.get('CAAC_RETRY_AFTER', 30))  # seconds
+JOB_TTL = int(os.environ.get('CAAC_JOB_TTL', 3600))        # seconds to keep finished jobs
+JOB_TIMEOUT = float(os.environ.get('CAAC_JOB_TIMEOUT', 600))  # seconds to generate a map, or 0
+
+# Finished maps are cached by request, in memory and optionally on disk.
+CACHE_BYTES = int(os.environ.get('CAAC_CACHE_BYTES', 32 * 1024 * 1024))
+CACHE_DIR = os.environ.get('CAAC_CACHE_DIR')
+CACHE_DISK_BYTES = int(os.environ.get('CAAC_CACHE_DISK_BYTES', 512 * 1024 * 1024))
+
+# POST /v1/render answers in the response for maps predicted to take at most
+# this many seconds, rendering up to SYNC_RENDERS of them at a time.
+SYNC_MAX_SECONDS = float(os.environ.get('CAAC_SYNC_MAX_SECONDS', 5))
+SYNC_RENDERS = int(os.environ.get('CAAC_SYNC_RENDERS', 1))
+
+# Jobs that genmap.estimate costs above this go to a separate, smaller pool, so
+# that they don't hold up cheap ones. The default is about five minutes of
+# rendering: output/topics.json at 2048x2048 is cheap, at 4096x4096 expensive.
+EXPENSIVE_COST = float(os.environ.get('CAAC_EXPENSIVE_COST', 2e7))
+SLOW_WORKERS = int(os.environ.get('CAAC_SLOW_WORKERS', 1))
+SLOW_QUEUE_DEPTH = int(os.environ.get('CAAC_SLOW_QUEUE_DEPTH', 4))
+
+# Queued jobs run shortest (by predicted seconds) first, less AGING seconds for
+# every second they've waited, so that long jobs aren't put off forever.
+AGING = float(os.environ.get('CAAC_AGING', 1))
+
+# With a job store (a SQLite database path), jobs are queued there, for
+# runner.py processes to run, instead of in this process's memory.
+JOB_STORE = os.environ.get('CAAC_JOB_STORE')
+SVG_DIR = None  # where to write rendered SVGs; None for the system's temporary directory
+
+# Callbacks are delivered by their own threads, retrying with exponential backoff.
+CALLBACK_WORKERS = int(os.environ.get('CAAC_CALLBACK_WORKERS', 4))
+CALLBACK_TIMEOUT = float(os.environ.get('CAAC_CALLBACK_TIMEOUT', 30))  # seconds
+CALLBACK_RETRIES = int(os.environ.get('CAAC_CALLBACK_RETRIES', 5))
+CALLBACK_BACKOFF = float(os.environ.get('CAAC_CALLBACK_BACKOFF', 2))   # seconds, doubling
+
 
 # Job Class
 # =========
 
-class Job(threading.Thread):
+class Job(object):
+    """A map to generate. Its status goes from queued to running to done, failed or timed out.
+    """
 
-    is_daemon = True
+    def __init__(self, callback_url, topics, kwargs):
+        self.id = uuid.uuid4().hex
+        self.key = request_key(topics, kwargs)
+        self.estimate = genmap.estimate(topics, **kwargs)
+        self.pool = None
+        self.runner = None  # which runner.py process has leased us from the job store, if any
+        self.deadline = Deadline(JOB_TIMEOUT or inf, start=False)  # starts when rendering does
+        self.callback_url = callback_url
+        self.topics = topics
+        self.kwargs = kwargs
+        self.status = 'queued'
+        self.error = None
+        self.svg_path = None
+        self.submitted_at = time.time()
+        self.started_at = self.finished_at = None
+        self.leader = None   # the identical job we're waiting on, if any
+        self.followers = []  # identical jobs waiting on us
+        self.callback = {'status': 'pending' if callback_url else None, 'attempts': 0, 'error': None}
 
     def run(self):
-        callback_url, topics = self._args
-        fp = io.StringIO()
-        big, blocks = genmap.generate_map(topics, **self._kwargs)
-        genmap.output_svg(topics, fp, big, blocks)
+        self.started_at = time.time()
+        self.status = 'running'
+        failure = None
+        try:
+            self.svg_path = render_in_pool(self.topics, self.kwargs, self.deadline)
+        except Exception as exc:
+            failure = exc
+            self.error = '{}: {}'.format(type(exc).__name__, exc)
+            status = 'timed out' if isinstance(exc, DeadlineExceeded) else 'failed'
+        else:
+            status = 'done'
+            svg_cache.set(self.key, self.svg_path)
+        self.finished_at = time.time()
+        self.status = status  # last, so a job that looks finished has all of its fields
+        if failure is None:
+            metrics.observe('caac_job_seconds', self.finished_at - self.started_at)
+            runtimes.record(self.estimate, self.finished_at - self.started_at)
+        self.topics = None  # we're done with it, and it can be big
+        if not self.save():
+            self.discard()  # we lost our lease, and the runner that took over will deliver
+            return
+        followers = in_flight.land(self) if store is None else self._stored_followers()
+        for follower in followers:
+            follower.follow(self)  # the store finished their rows when we saved ours
+        if failure is not None:
+            raise failure
+        for job in [self] + followers:
+            delivery.submit(job)
+
+    def _stored_followers(self):
+        """Return jobs for the rows that the job store had follow us, to deliver their callbacks.
+        """
+        followers = []
+        for row in store.followers(self.id):
+            follower = copy.copy(self)
+            follower.id = row['id']
+            follower.callback_url = row['callback_url']
+            follower.callback = row['callback']
+            follower.submitted_at = row['submitted_at']
+            follower.runner = None
+            follower.leader, follower.followers = self, []
+            followers.append(follower)
+        return followers
+
+    def follow(self, leader):
+        """Finish the way leader did, sharing its SVG.
+        """
+        self.svg_path = leader.svg_path
+        self.status = leader.status
+        self.error = leader.error
+        self.started_at = leader.started_at
+        self.finished_at = leader.finished_at
+        self.topics = None
+
+    def finish_from_cache(self, svg):
+        """Finish with an SVG someone else already rendered.
+        """
+        self.started_at = time.time()
+        fd, self.svg_path = tempfile.mkstemp(prefix='caac-map-', suffix='.svg', dir=SVG_DIR)
+        with io.open(fd, 'wb') as fp:
+            fp.write(svg)
+        self.finished_at = time.time()
+        self.topics = None
+        self.status = 'done'
+
+    def save(self):
+        """Store our progress in the job store, if there is one. Return False if it isn't ours to store.
+        """
+        return store is None or store.save(self)
+
+    def discard(self):
+        """Remove our SVG, if we have one.
+        """
+        if self.svg_path:
+            try:
+                os.remove(self.svg_path)
+            except OSError:
+                pass
+
+    @property
+    def progress(self):
+        """The job whose status, error and SVG are ours: our leader's until we've finished following it.
+        """
+        return self.leader if self.leader is not None and self.finished_at is None else self
+
+    def describe(self, position=None):
+        progress = self.progress
+        return { 'id': self.id
+               , 'status': progress.status
+               , 'position': position
+               , 'error': progress.error
+               , 'submitted_at': self.submitted_at
+               , 'started_at': progress.started_at
+               , 'finished_at': self.finished_at
+               , 'callback': self.callback
+               , 'estimate': self.estimate
+                }
+
+    @property
+    def expensive(self):
+        return self.estimate['cost'] > EXPENSIVE_COST
+
+    @property
+    def lane(self):
+        return 'slow' if self.expensive else 'fast'
+
+
+class SingleFlight(object):
+    """Run only one of any identical jobs at a time, and let the rest follow it.
+    """
+
+    def __init__(self):
+        self.leaders = {}
+        self.lock = threading.Lock()
+
+    def submit(self, job, submit):
+        """Attach job to an identical job in flight, or else submit it and lead.
+
+        Return the leader job is following, or None if it's leading. Errors
+        from submit (QueueFull, say) propagate, and leave job out of flight.
+
+        """
+        with self.lock:
+            leader = self.leaders.get(job.key)
+            if leader is not None:
+                job.leader = leader
+                leader.followers.append(job)
+                return leader
+            submit(job)
+            self.leaders[job.key] = job
+            return None
+
+    def land(self, job):
+        """Take job out of flight, and return its followers. No more can join after this.
+        """
+        with self.lock:
+            if self.leaders.get(job.key) is job:
+                del self.leaders[job.key]
+            return list(job.followers)
+
+
+class Jobs(object):
+    """Jobs by id, forgotten (SVG and all) ttl seconds after they finish.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def add(self, job):
+        self.expire()
+        with self.lock:
+            self.jobs[job.id] = job
+
+    def get(self, job_id):
+        self.expire()
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def expire(self):
+        cutoff = time.time() - self.ttl
+        with self.lock:
+            expired = [job for job in self.jobs.values()
+                       if job.finished_at is not None and job.finished_at < cutoff]
+            for job in expired:
+                del self.jobs[job.id]
+        for job in expired:
+            job.discard()
+
+
+# Result Cache
+# ============
+
+def request_key(topics, kwargs):
+    """Return a hash of everything about a request that affects the map it gets.
+
+    That's the generate_map options (defaults filled in), and the topic,
+    subtopic and resource ids and pathways. Other resource fields don't make
+    it into the SVG, and dict order doesn't matter, since layout is random.
+
+    """
+    options = {name: param.default for name, param
+               in inspect.signature(genmap.generate_map).parameters.items()
+               if param.default is not param.empty}
+    options.update(kwargs)
+    for name, value in options.items():
+        if isinstance(value, str) and value.isdigit():
+            options[name] = int(value)
+    ids = {topic_id: {subtopic_id: [ subtopic['dag']['names']
+                                   , sorted(resource['id'] for resource in subtopic['resources'].values())
+                                    ]
+                      for subtopic_id, subtopic in topic['subtopics'].items()}
+           for topic_id, topic in topics.items()}
+    canonical = json.dumps([options, ids], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf8')).hexdigest()
+
+
+class SVGCache(object):
+    """Rendered SVGs by request key, in memory, and on disk if we have a disk cache.
+    """
+
+    def __init__(self, memory, disk=None):
+        self.memory = memory
+        self.disk = disk
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            svg = self.memory.get(key)
+        if svg is None and self.disk is not None:
+            hit = self.disk.get(key)
+            if hit is not None:
+                svg = hit[0]
+                with self.lock:
+                    self.memory.set(key, svg)
+        return svg
+
+    def set(self, key, path):
+        """Cache the SVG in the file at path.
+        """
+        with open(path, 'rb') as fp:
+            svg = fp.read()
+        with self.lock:
+            self.memory.set(key, svg)
+        if self.disk is not None:
+            self.disk.set(key, svg)
+
+
+svg_cache = SVGCache( LRUCache(CACHE_BYTES)
+                    , DiskCache(CACHE_DIR, CACHE_DISK_BYTES) if CACHE_DIR else None
+                     )
+
+
+# Rendering
+# =========
+
+_processes = None
+_processes_lock = threading.Lock()
+
+
+def render(topics, kwargs, deadline=None):
+    """Generate a map, write its SVG to a temporary file, and return (path, observations).
+
+    This runs in a pool process, so the SVG comes back by way of the
+    filesystem rather than being pickled back to us, and metrics come back
+    as a list of observations to replay. The deadline, if any, starts here,
+    not while we wait for a pool process; if it passes first, raise
+    DeadlineExceeded, which frees the pool process.
+
+    """
+    if deadline is not None:
+        deadline.start()
+    fd, path = tempfile.mkstemp(prefix='caac-map-', suffix='.svg', dir=SVG_DIR)
+    try:
+        with metrics.capture() as observations:
+            with io.open(fd, 'w', encoding='utf8') as fp:
+                big, blocks = genmap.generate_map(topics, deadline=deadline, **kwargs)
+                genmap.output_svg(topics, fp, big, blocks, deadline=deadline)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path, observations
+
+
+def render_in_pool(topics, kwargs, deadline=None):
+    """Render in the process pool (started on first use), and wait for the path.
+
+    If a pool process dies (killed for running out of memory, say), the
+    pool is broken for good: the renders it was running fail, and we start
+    a new pool for the next ones.
+
+    """
+    if not PROCESSES:
+        path, observations = render(topics, kwargs, deadline)
+    else:
+        processes = _pool()
+        try:
+            future = processes.submit(render, topics, kwargs, deadline)
+        except BrokenProcessPool:  # by someone else's render, so ours can try a new pool
+            future = _pool(broken=processes).submit(render, topics, kwargs, deadline)
+        try:
+            path, observations = future.result()
+        except BrokenProcessPool:
+            _pool(broken=processes)
+            raise
+    metrics.replay(observations)
+    return path
+
+
+def _pool(broken=None):
+    """Return the process pool, starting one if there isn't one, or if the current one is broken.
+    """
+    global _processes
+    with _processes_lock:
+        if _processes is not None and _processes is broken:
+            _processes.shutdown(wait=False)
+            _processes = None
+        if _processes is None:
+            _processes = ProcessPoolExecutor(max_workers=PROCESSES)
+        return _processes
+
+
+# Worker Pool
+# ===========
+
+class QueueFull(Exception): pass
+
+
+class JobQueue(object):
+    """A bounded queue of jobs that, unlike queue.Queue, can tell where a job is in line.
+
+    Jobs come out first in, first out, or, given a priority function of
+    (job, now), lowest priority first, with ties first in, first out.
+    Priorities are worked out on every get, so they can change while jobs
+    wait. Queues are short, so scanning them is cheap.
 
-        fp.seek(0)
-        requests.post(callback_url, data=fp.read(), headers={'Content-Type': 'image/svg+xml'})
+    """
+
+    def __init__(self, depth, priority=None):
+        self.depth = depth
+        self.priority = priority
+        self.jobs = []  # in the order they arrived
+        self.condition = threading.Condition()
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def put(self, job):
+        with self.condition:
+            if len(self.jobs) >= self.depth:
+                raise QueueFull()
+            self.jobs.append(job)
+            self.condition.notify()
+
+    def get(self):
+        with self.condition:
+            while not self.jobs:
+                self.condition.wait()
+            job = self._line()[0]
+            self.jobs.remove(job)
+            return job
+
+    def position(self, job):
+        """Return how many jobs are ahead of job in line, or None if it isn't queued.
+        """
+        with self.condition:
+            try:
+                return self._line().index(job)
+            except ValueError:
+                return None
+
+    def _line(self):
+        if self.priority is None:
+            return list(self.jobs)
+        now = time.time()
+        order = sorted((self.priority(job, now), i) for i, job in enumerate(self.jobs))
+        return [self.jobs[i] for _, i in order]
+
+
+class RuntimeHistory(object):
+    """How long jobs of various sizes have taken, as moving averages.
+
+    Jobs are bucketed by the order of magnitude (in bits) of their canvas
+    cells and resources. For a bucket we haven't seen, we scale the job's
+    estimated cost by the average seconds per unit of cost across all jobs
+    (or by genmap's calibration, before there are any). Given a job store,
+    the averages are kept there, so that web processes rank jobs by what
+    runners have learned.
+
+    """
+
+    def __init__(self, alpha=0.3, seconds_per_cost=genmap.SECONDS_PER_COST, store=None):
+        self.alpha = alpha  # weight of the latest observation
+        self.seconds_per_cost = seconds_per_cost
+        self.seconds = {}
+        self.store = store
+        self.lock = threading.Lock()
+
+    def _average(self, average, value):
+        return value if average is None else average + self.alpha * (value - average)
+
+    @staticmethod
+    def bucket(estimate):
+        return '{}x{}'.format(int(estimate['cells']).bit_length(), estimate['resources'].bit_length())
+
+    def record(self, estimate, seconds):
+        bucket = self.bucket(estimate)
+        rate = seconds / estimate['cost'] if estimate['cost'] else None
+        if self.store is not None:
+            self.store.average(bucket, seconds, self.alpha)
+            if rate is not None:
+                self.store.average('seconds_per_cost', rate, self.alpha, self.seconds_per_cost)
+            return
+        with self.lock:
+            self.seconds[bucket] = self._average(self.seconds.get(bucket), seconds)
+            if rate is not None:
+                self.seconds_per_cost = self._average(self.seconds_per_cost, rate)
+
+    def predict(self, estimate):
+        bucket = self.bucket(estimate)
+        if self.store is not None:
+            averages = self.store.averages(bucket, 'seconds_per_cost')
+            seconds = averages.get(bucket)
+            seconds_per_cost = averages.get('seconds_per_cost', self.seconds_per_cost)
+        else:
+            with self.lock:
+                seconds, seconds_per_cost = self.seconds.get(bucket), self.seconds_per_cost
+        return estimate['cost'] * seconds_per_cost if seconds is None else seconds
+
+
+def shortest_first(job, now):
+    return runtimes.predict(job.estimate) - AGING * (now - job.submitted_at)
+
+
+class WorkerPool(object):
+    """A fixed number of threads running jobs from a JobQueue.
+
+    Threads are started on the first submit, so that each gunicorn worker
+    process gets its own.
+
+    """
+
+    def __init__(self, nworkers, queue):
+        self.nworkers = nworkers
+        self.queue = queue
+        self.threads = []
+        self.active = 0
+        self.lock = threading.Lock()
+
+    def submit(self, job):
+        with self.lock:
+            if not self.threads:
+                for i in range(self.nworkers):
+                    thread = threading.Thread(target=self.work, name='worker-{}'.format(i))
+                    thread.daemon = True
+                    thread.start()
+                    self.threads.append(thread)
+        self.queue.put(job)
+
+    def work(self):
+        while 1:
+            job = self.queue.get()
+            with self.lock:
+                self.active += 1
+            try:
+                job.run()
+            except Exception:
+                traceback.print_exc()
+            finally:
+                with self.lock:
+                    self.active -= 1
+
+
+store = JobStore(JOB_STORE) if JOB_STORE else None
+if store is not None:
+    SVG_DIR = store.svg_dir
+runtimes = RuntimeHistory(store=store)
+pool = WorkerPool(WORKERS, JobQueue(QUEUE_DEPTH, shortest_first))
+slow_pool = WorkerPool(SLOW_WORKERS, JobQueue(SLOW_QUEUE_DEPTH, shortest_first))
+jobs = Jobs(JOB_TTL)
+in_flight = SingleFlight()
+sync_renders = threading.BoundedSemaphore(SYNC_RENDERS)
+
+
+# Callback Delivery
+# =================
+
+class Delivery(object):
+    """Threads POSTing finished maps to their callback URLs, so workers don't have to.
+
+    Connections are pooled in one session. Each attempt times out, and
+    connection errors, timeouts, 408s, 429s and 5xxs are retried after
+    backoff, 2 * backoff, 4 * backoff, ... seconds, up to retries times.
+    Retries wait in a heap rather than in a thread, so slow or broken
+    receivers only hold a thread for one attempt at a time. Threads are
+    started on the first submit.
+
+    """
+
+    def __init__(self, nworkers, timeout, retries, backoff):
+        self.nworkers = nworkers
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=nworkers, pool_maxsize=nworkers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.pending = []  # heap of (due, seq, job, enqueued_at)
+        self.seq = itertools.count()
+        self.condition = threading.Condition()
+        self.threads = []
+        self.stats = Counter()  # delivered, retried, failed, and seconds (spent delivering)
+
+    def submit(self, job, due=None, enqueued_at=None):
+        if not job.callback_url:
+            return
+        with self.condition:
+            if not self.threads:
+                for i in range(self.nworkers):
+                    thread = threading.Thread(target=self.work, name='delivery-{}'.format(i))
+                    thread.daemon = True
+                    thread.start()
+                    self.threads.append(thread)
+            now = time.time()
+            heapq.heappush(self.pending, (due or now, next(self.seq), job, enqueued_at or now))
+            self.condition.notify()
+
+    def count(self, **counts):
+        with self.condition:
+            self.stats.update(counts)
+        for outcome in ('delivered', 'retried', 'failed'):
+            if outcome in counts:
+                metrics.observe('caac_callbacks_total', counts[outcome], outcome=outcome)
+        if 'seconds' in counts:
+            metrics.observe('caac_callback_seconds', counts['seconds'])
+
+    def take(self):
+        with self.condition:
+            while 1:
+                if self.pending:
+                    wait = self.pending[0][0] - time.time()
+                    if wait <= 0:
+                        return heapq.heappop(self.pending)[2:]
+                else:
+                    wait = None
+                self.condition.wait(wait)
+
+    def work(self):
+        while 1:
+            job, enqueued_at = self.take()
+            try:
+                self.attempt(job, enqueued_at)
+            except Exception:
+                traceback.print_exc()
+
+    def attempt(self, job, enqueued_at):
+        job.callback['attempts'] += 1
+        try:
+            with open(job.svg_path, 'rb') as fp:
+                response = self.session.post( job.callback_url
+                                            , data=fp
+                                            , headers={'Content-Type': 'image/svg+xml'}
+                                            , timeout=self.timeout
+                                             )
+        except requests.RequestException as exc:
+            error, retry = '{}: {}'.format(type(exc).__name__, exc), True
+        else:
+            status = response.status_code
+            response.close()
+            if status < 400:
+                job.callback.update(status='delivered', error=None)
+                job.save()
+                self.count(delivered=1, seconds=time.time() - enqueued_at)
+                return
+            error, retry = 'HTTP {}'.format(status), status in (408, 429) or status >= 500
+
+        job.callback['error'] = error
+        if retry and job.callback['attempts'] <= self.retries:
+            self.count(retried=1)
+            backoff = self.backoff * 2 ** (job.callback['attempts'] - 1)
+            self.submit(job, time.time() + backoff, enqueued_at)
+        else:
+            job.callback['status'] = 'failed'
+            self.count(failed=1)
+        job.save()
+
+
+delivery = Delivery(CALLBACK_WORKERS, CALLBACK_TIMEOUT, CALLBACK_RETRIES, CALLBACK_BACKOFF)
+
+
+# Metrics
+# =======
+
+def _cache_hit_ratio():
+    hits = metrics.REGISTRY['caac_cache_requests_total'].get(result='hit')
+    misses = metrics.REGISTRY['caac_cache_requests_total'].get(result='miss')
+    return hits / (hits + misses) if hits + misses else 0
+
+def _queue_depth(lane):
+    if store is not None:
+        return store.count('queued', lane)
+    return len((slow_pool if lane == 'slow' else pool).queue)
+
+def _jobs_active():
+    return store.count('running') if store is not None else pool.active + slow_pool.active
+
+metrics.Gauge('caac_queue_depth', 'Jobs waiting for a worker.', lambda: _queue_depth('fast'))
+metrics.Gauge('caac_slow_queue_depth', 'Expensive jobs waiting for a worker.', lambda: _queue_depth('slow'))
+metrics.Gauge('caac_jobs_active', 'Jobs being worked on.', _jobs_active)
+metrics.Gauge('caac_callbacks_pending', 'Callbacks waiting to be delivered or retried.',
+              lambda: len(delivery.pending))
+metrics.Gauge('caac_cache_hit_ratio', 'Share of map requests answered from the SVG cache.',
+              _cache_hit_ratio)
 
 
 # Flask App
@@ -46,8 +715,154 @@ def v1():
     kw = flask.request.get_json()
     callback_url = kw.pop('callback_url')
     topics = kw.pop('topics')
-    Job(args=(callback_url, topics), kwargs=kw).start()
-    return ''
+    job = Job(callback_url, topics, kw)
+    return _refuse(job) or _submit(job)
+
+@app.route('/v1/render', methods=['POST'])
+def render_now():
+    kw = flask.request.get_json()
+    callback_url = kw.pop('callback_url', None)
+    topics = kw.pop('topics')
+    job = Job(callback_url, topics, kw)
+    refusal = _refuse(job)
+    if refusal:
+        return refusal
+    svg = _cached(job.key)
+    if svg is None and runtimes.predict(job.estimate) > SYNC_MAX_SECONDS:
+        return _submit(job, status=202)
+    if svg is None and not sync_renders.acquire(blocking=False):
+        return _submit(job, status=202)
+    metrics.observe('caac_cache_requests_total', result='miss' if svg is None else 'hit')
+    if svg is None:
+        try:
+            job.started_at, job.status = time.time(), 'running'  # not queued, as far as the store goes
+            _remember(job)
+            try:
+                job.run()
+            except Exception:
+                traceback.print_exc()
+                return flask.Response( 'We failed to generate this map: {}\n'.format(job.error)
+                                     , status=500
+                                      )
+        finally:
+            sync_renders.release()
+        with open(job.svg_path, 'rb') as fp:
+            svg = fp.read()
+    else:
+        job.finish_from_cache(svg)
+        _remember(job)
+        delivery.submit(job)
+    return flask.Response(svg, mimetype='image/svg+xml', headers={'X-Job-Id': job.id})
+
+def _refuse(job):
+    """Return a response turning job away if it can never fit, or None.
+    """
+    if job.estimate['feasible']:
+        return None
+    response = flask.jsonify( error='This map can never fit: {}.'.format(job.estimate['problem'])
+                            , estimate=job.estimate
+                             )
+    response.status_code = 422
+    return response
+
+def _submit(job, status=200):
+    """Finish job from the cache, or else queue it, and respond with where to find it.
+    """
+    svg = _cached(job.key)
+    metrics.observe('caac_cache_requests_total', result='miss' if svg is None else 'hit')
+    if svg is not None:
+        job.finish_from_cache(svg)
+        _remember(job)
+        delivery.submit(job)
+        return _accepted(job, status)
+    try:
+        if store is not None:
+            depth = SLOW_QUEUE_DEPTH if job.expensive else QUEUE_DEPTH
+            rank = runtimes.predict(job.estimate) + AGING * job.submitted_at  # shortest_first, in SQL
+            if not store.put(job, rank, depth):
+                raise QueueFull()
+        else:
+            job.pool = slow_pool if job.expensive else pool
+            in_flight.submit(job, job.pool.submit)
+            jobs.add(job)
+    except QueueFull:
+        return flask.Response( 'Too many maps in the queue. Please try again later.\n'
+                             , status=503
+                             , headers={'Retry-After': str(RETRY_AFTER)}
+                              )
+    return _accepted(job, status)
+
+def _cached(key):
+    """Return the SVG rendered for requests with key, or None.
+
+    Runners render in other processes, so with a job store we also look for a
+    job done there for key, as long as its SVG hasn't been expired away.
+
+    """
+    svg = svg_cache.get(key)
+    if svg is None and store is not None:
+        path = store.rendered(key, JOB_TTL)
+        if path is not None:
+            try:
+                with open(path, 'rb') as fp:
+                    svg = fp.read()
+            except OSError:
+                pass
+    return svg
+
+def _remember(job):
+    if store is not None:
+        store.add(job)
+    else:
+        jobs.add(job)
+
+def _accepted(job, status):
+    url = flask.url_for('job_status', job_id=job.id)
+    return flask.jsonify(id=job.id, url=url, estimate=job.estimate), status
+
+def _describe_or_404(job_id):
+    """Return a description of the job, and the path to its SVG (if any).
+    """
+    if store is not None:
+        row = store.get(job_id)  # runners expire old jobs, so we needn't take the write lock here
+        if row is None:
+            flask.abort(404)
+        leader = store.get(row['leader']) if row['leader'] and row['finished_at'] is None else None
+        progress = leader or row
+        fields = ('id', 'submitted_at', 'finished_at', 'callback', 'estimate')
+        description = {name: row[name] for name in fields}
+        description.update( status=progress['status'], error=progress['error']
+                          , started_at=progress['started_at']
+                           )
+        description['position'] = store.position(progress)
+        return description, progress['svg_path']
+    job = jobs.get(job_id)
+    if job is None:
+        flask.abort(404)
+    leader = job.leader or job
+    position = leader.pool.queue.position(leader) if leader.pool else None
+    return job.describe(position), job.progress.svg_path
+
+@app.route('/v1/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    return flask.jsonify(_describe_or_404(job_id)[0])
+
+@app.route('/v1/jobs/<job_id>/svg', methods=['GET'])
+def job_svg(job_id):
+    description, svg_path = _describe_or_404(job_id)
+    status = description['status']
+    if status != 'done':
+        unfinished = status in ('queued', 'running')
+        return flask.Response( 'This map is {}.\n'.format(status)
+                             , status=409
+                             , headers={'Retry-After': str(RETRY_AFTER)} if unfinished else {}
+                              )
+    return flask.send_file(svg_path, mimetype='image/svg+xml')
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_():
+    return flask.Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 
 if DEV:
@@ -0,0 +1,113 @@
+"""Compact binary snapshots of topics, for map generation.
+
+topics.json stays the interchange format, but it's big, and to generate a map
+we only need ids, subtopics, and DAG orderings. A snapshot keeps just those,
+one zlib-compressed blob per topic, behind an index of offsets, so that a
+single topic can be loaded without decoding the rest:
+
+    magic (8 bytes) | index length (4 bytes, big-endian) | index | blobs ...
+
+The index is compact JSON: [[topic_id, offset, length], ...], with offsets
+counted from the end of the index.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import struct
+import zlib
+from collections.abc import Mapping
+
+
+MAGIC = b'CAACSNP1'
+HEADER = struct.Struct('>8sI')
+
+
+class BadSnapshot(Exception): pass
+
+
+def _compact(topic):
+    subtopics = []
+    for subtopic in topic['subtopics'].values():
+        names = subtopic['dag']['names']
+        extra = sorted(set(subtopic['resources']) - set(names))
+        subtopics.append([subtopic['id'], names, extra])
+    return [topic['id'], subtopics]
+
+
+def _expand(compact):
+    topic_id, subtopics = compact
+    topic = {'id': topic_id, 'subtopics': {}}
+    for subtopic_id, names, extra in subtopics:
+        resources = {uid: {'id': uid, 'topic_id': topic_id, 'subtopic_id': subtopic_id}
+                     for uid in names + extra}
+        topic['subtopics'][subtopic_id] = { 'id': subtopic_id
+                                          , 'topic_id': topic_id
+                                          , 'dag': {'names': names}
+                                          , 'resources': resources
+                                           }
+    return topic
+
+
+def _encode(obj):
+    return json.dumps(obj, separators=(',', ':')).encode('utf8')
+
+
+def dump(topics, fspath):
+    """Write a snapshot of topics to fspath.
+    """
+    index, blobs, offset = [], [], 0
+    for topic_id in sorted(topics):
+        blob = zlib.compress(_encode(_compact(topics[topic_id])))
+        index.append([topic_id, offset, len(blob)])
+        blobs.append(blob)
+        offset += len(blob)
+    index = _encode(index)
+    with open(fspath, 'wb') as fp:
+        fp.write(HEADER.pack(MAGIC, len(index)))
+        fp.write(index)
+        for blob in blobs:
+            fp.write(blob)
+
+
+class Snapshot(Mapping):
+    """A read-only mapping of topic id to topic, decoded lazily from a snapshot file.
+
+    Topics have the same shape as in topics.json, minus everything but ids:
+    resources only have id, topic_id and subtopic_id, and DAGs only names.
+
+    """
+
+    def __init__(self, fspath):
+        self.fspath = fspath
+        with open(fspath, 'rb') as fp:
+            header = fp.read(HEADER.size)
+            if len(header) < HEADER.size:
+                raise BadSnapshot(fspath)
+            magic, index_length = HEADER.unpack(header)
+            if magic != MAGIC:
+                raise BadSnapshot(fspath)
+            index = json.loads(fp.read(index_length).decode('utf8'))
+        self.data_offset = HEADER.size + index_length
+        self.index = {topic_id: (offset, length) for topic_id, offset, length in index}
+        self.order = [entry[0] for entry in index]
+        self._topics = {}
+
+    def __getitem__(self, topic_id):
+        if topic_id not in self._topics:
+            offset, length = self.index[topic_id]
+            with open(self.fspath, 'rb') as fp:
+                fp.seek(self.data_offset + offset)
+                blob = fp.read(length)
+            self._topics[topic_id] = _expand(json.loads(zlib.decompress(blob).decode('utf8')))
+        return self._topics[topic_id]
+
+    def __iter__(self):
+        return iter(self.order)
+
+    def __len__(self):
+        return len(self.order)
+
+
+def load(fspath):
+    return Snapshot(fspath)
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+"""Local, replayable data sources for fetch.py.
+
+fetch.py normally reads worksheets from Google Sheets. For benchmarking and
+load testing we want the same ingest path without the network, so here we can:
+
+    record      download a real sheet's worksheets into a directory
+    synthesize  write fake worksheets of a configured size into a directory
+    serve       serve a directory over HTTP, with configured latency and bandwidth
+    bench       time fetch against a directory, across worker counts, cold and warm
+
+A recorded directory holds one CSV per worksheet, plus worksheets.json listing
+[title, filename] pairs in worksheet order. A source is anything with a
+worksheets() method returning [(title, url)], which fetch.main accepts in
+place of a sheet key: Directory reads from disk (through a requests adapter,
+so that caching and streaming behave as they do over the network), and
+Replay reads from a serve()d directory over HTTP.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import csv
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import shutil
+import socketserver
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+from urllib.parse import unquote, urlparse
+from urllib.request import url2pathname
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+import fetch
+from cache import DiskCache
+
+
+LISTING = 'worksheets.json'
+
+
+def _etag(data):
+    return '"{}"'.format(hashlib.sha1(data).hexdigest())
+
+
+def _listing(directory):
+    with open(os.path.join(directory, LISTING)) as fp:
+        return json.load(fp)
+
+
+# Sources
+# =======
+
+class Directory(object):
+    """Replay a recorded directory straight from the filesystem.
+    """
+
+    def __init__(self, directory, latency=0):
+        self.directory = os.path.abspath(directory)
+        self.latency = latency
+
+    def worksheets(self):
+        fetch.session.mount('file://', FileAdapter(self.latency))
+        uri = lambda filename: Path(self.directory, filename).as_uri()
+        return [(title, uri(filename)) for title, filename in _listing(self.directory)]
+
+
+class Replay(object):
+    """Replay a recorded directory from a serve()d base URL.
+    """
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def worksheets(self):
+        listing = json.loads(fetch._get(self.base_url + '/' + LISTING))
+        return [(title, self.base_url + '/' + filename) for title, filename in listing]
+
+
+class FileAdapter(requests.adapters.BaseAdapter):
+    """A requests transport adapter for file: URLs, with conditional GETs and fake latency.
+    """
+
+    def __init__(self, latency=0):
+        super(FileAdapter, self).__init__()
+        self.latency = latency
+
+    def send(self, request, **kw):
+        time.sleep(self.latency)
+        response = requests.Response()
+        response.request = request
+        response.url = request.url
+        response.encoding = 'utf8'
+        response.headers = CaseInsensitiveDict()
+        try:
+            with open(url2pathname(urlparse(request.url).path), 'rb') as fp:
+                data = fp.read()
+        except IOError:
+            response.status_code = 404
+            response.raw = io.BytesIO(b'')
+            return response
+        response.headers['ETag'] = etag = _etag(data)
+        if request.headers.get('If-None-Match') == etag:
+            response.status_code = 304
+            data = b''
+        else:
+            response.status_code = 200
+        response.raw = io.BytesIO(data)
+        return response
+
+    def close(self):
+        pass
+
+
+# Recording
+# =========
+
+def record(worksheets, directory):
+    """Download worksheets (from fetch.fetch_worksheets, say) into directory.
+    """
+    os.makedirs(directory, exist_ok=True)
+    listing = []
+    for i, (title, raw, stale) in enumerate(fetch.fetch_csvs(worksheets)):
+        filename = '{:03}-{}.csv'.format(i, re.sub(r'[^a-z0-9]+', '-', title.lower()).strip('-'))
+        with io.open(os.path.join(directory, filename), 'w', encoding='utf8', newline='') as fp:
+            fp.write(raw)
+        listing.append([title, filename])
+    with open(os.path.join(directory, LISTING), 'w+') as fp:
+        json.dump(listing, fp, indent=4)
+    return listing
+
+
+def synthesize(directory, ntopics=10, nrows=100, nsubtopics=4, row_bytes=1000, seed=0):
+    """Write ntopics fake worksheets of nrows each into directory.
+
+    Resources are chained into pathways within each subtopic the way real
+    sheets are, and each row is padded out to about row_bytes with filler
+    columns, to stand in for the display fields.
+
+    """
+    rand = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    headers = list(fetch.PIPELINE_FIELDS) + ['resource_name', 'resource_description']
+    listing = []
+    for t in range(ntopics):
+        title = 'topic-{:03}'.format(t)
+        out = io.StringIO()
+        writer = csv.writer(out, lineterminator='\n')
+        writer.writerow(headers)
+        previous = {}
+        for r in range(nrows):
+            uid = '{}-resource-{:05}'.format(title, r)
+            subtopic_id = 'subtopic-{}'.format(rand.randrange(nsubtopics))
+            before = previous.get(subtopic_id, '') if rand.random() < 0.8 else ''
+            previous[subtopic_id] = uid
+            filler = 'x' * max(0, row_bytes - len(uid) * 2 - 40)
+            writer.writerow([uid, subtopic_id, before, '', 'Resource {}'.format(r), filler])
+        filename = '{:03}-{}.csv'.format(t, title)
+        with io.open(os.path.join(directory, filename), 'w', encoding='utf8', newline='') as fp:
+            fp.write(out.getvalue())
+        listing.append([title, filename])
+    with open(os.path.join(directory, LISTING), 'w+') as fp:
+        json.dump(listing, fp, indent=4)
+    return listing
+
+
+# Serving
+# =======
+
+class _Server(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(directory, port=0, latency=0, bandwidth=None):
+    """Serve directory over HTTP on localhost from a background thread.
+
+    Each response waits latency seconds before it starts, and then trickles
+    out at bandwidth bytes per second if given. ETags and If-None-Match are
+    supported, so conditional requests work like they do against Google. The
+    returned server has a base_url; call shutdown() on it when done.
+
+    """
+    directory = os.path.abspath(directory)
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            time.sleep(latency)
+            path = os.path.join(directory, os.path.basename(unquote(urlparse(self.path).path)))
+            try:
+                with open(path, 'rb') as fp:
+                    data = fp.read()
+            except IOError:
+                self.send_error(404)
+                return
+            etag = _etag(data)
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/csv; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.send_header('ETag', etag)
+            self.end_headers()
+            chunk = 16384
+            for i in range(0, len(data), chunk):
+                self.wfile.write(data[i:i+chunk])
+                if bandwidth:
+                    time.sleep(chunk / bandwidth)
+
+        def log_message(self, *a):
+            pass
+
+    server = _Server(('127.0.0.1', port), Handler)
+    server.base_url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+# Benchmarking
+# ============
+
+def bench(source, workers=(1, 8), stream=False):
+    """Time fetching and building every topic from source, cold and then warm.
+
+    Cold runs start with an empty cache; warm runs revalidate against the
+    cache the cold run left behind. Return a list of (workers, cold, warm)
+    timings in seconds.
+
+    """
+    worksheets = source.worksheets()
+    results = []
+    for nworkers in workers:
+        cache_dir = tempfile.mkdtemp()
+        saved = fetch.cache
+        fetch.cache = DiskCache(cache_dir)
+        try:
+            timings = []
+            for run in ('cold', 'warm'):
+                start = time.time()
+                fetch.update_topics(worksheets, {}, {}, max_workers=nworkers, stream=stream)
+                timings.append(time.time() - start)
+        finally:
+            fetch.cache = saved
+            shutil.rmtree(cache_dir)
+        results.append((nworkers, timings[0], timings[1]))
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+    from contextlib import redirect_stdout
+
+    parser = argparse.ArgumentParser(description='Record, serve, and benchmark CaaC map data.')
+    commands = parser.add_subparsers(dest='command')
+
+    p = commands.add_parser('record', help='download a Google Sheet into a directory')
+    p.add_argument('sheets_key')
+    p.add_argument('directory')
+
+    p = commands.add_parser('synthesize', help='write fake worksheets into a directory')
+    p.add_argument('directory')
+    p.add_argument('--topics', '-t', default=10, type=int, help='the number of worksheets')
+    p.add_argument('--rows', '-r', default=100, type=int, help='the number of rows per worksheet')
+    p.add_argument('--row-bytes', '-b', default=1000, type=int, help='the size of each row')
+
+    for name, help in (('serve', 'serve a directory over HTTP'),
+                       ('bench', 'time fetching a directory over HTTP')):
+        p = commands.add_parser(name, help=help)
+        p.add_argument('directory')
+        p.add_argument('--port', '-p', default=0, type=int, help='the port to listen on')
+        p.add_argument('--latency', '-l', default=0, type=float,
+                       help='seconds to wait before each response')
+        p.add_argument('--bandwidth', '-w', default=None, type=int,
+                       help='bytes per second per response')
+    p.add_argument('--workers', '-n', default='1,8', type=lambda s: [int(n) for n in s.split(',')],
+                   help='comma-separated worker counts to try')
+    p.add_argument('--stream', '-s', action='store_true', help='use the streaming parser')
+
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        record(fetch.fetch_worksheets(args.sheets_key), args.directory)
+    elif args.command == 'synthesize':
+        synthesize(args.directory, args.topics, args.rows, row_bytes=args.row_bytes)
+    elif args.command == 'serve':
+        server = serve(args.directory, args.port, args.latency, args.bandwidth)
+        print("Serving {} at {} ...".format(args.directory, server.base_url))
+        try:
+            while 1:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
+    elif args.command == 'bench':
+        server = serve(args.directory, args.port, args.latency, args.bandwidth)
+        with redirect_stdout(io.StringIO()):
+            results = bench(Replay(server.base_url), args.workers, args.stream)
+        server.shutdown()
+        print("{:>8} {:>10} {:>10}".format("workers", "cold (s)", "warm (s)"))
+        for nworkers, cold, warm in results:
+            print("{:>8} {:>10.3f} {:>10.3f}".format(nworkers, cold, warm))
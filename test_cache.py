@@ -0,0 +1,52 @@
+import os
+import time
+
+from cache import DiskCache, LRUCache
+
+
+def test_cache_round_trips_body_and_meta(tmpdir):
+    cache = DiskCache(str(tmpdir))
+    assert cache.get('http://example.com/') is None
+    cache.set('http://example.com/', b'body', etag='"abc"')
+    body, meta = cache.get('http://example.com/')
+    assert body == b'body'
+    assert meta['etag'] == '"abc"'
+    assert meta['key'] == 'http://example.com/'
+
+def test_cache_evicts_least_recently_used_over_max_bytes(tmpdir):
+    cache = DiskCache(str(tmpdir), max_bytes=8)
+    cache.set('a', b'1234')
+    cache.set('b', b'1234')
+    past = time.time() - 100
+    for _, _, base in cache.entries():
+        os.utime(base + '.body', (past, past))
+    cache.get('a')  # a is now the most recently used
+    cache.set('c', b'1234')
+    assert cache.get('a') is not None
+    assert cache.get('b') is None
+    assert cache.get('c') is not None
+
+def test_cache_expires_entries_past_max_age(tmpdir):
+    cache = DiskCache(str(tmpdir), max_age=60)
+    cache.set('a', b'old')
+    past = time.time() - 120
+    for _, _, base in cache.entries():
+        os.utime(base + '.body', (past, past))
+    assert cache.get('a') is None
+    assert cache.entries() == []
+
+def test_lru_cache_evicts_least_recently_used_over_max_bytes():
+    cache = LRUCache(max_bytes=8)
+    cache.set('a', b'1234')
+    cache.set('b', b'1234')
+    cache.get('a')
+    cache.set('c', b'1234')
+    assert cache.get('a') == b'1234'
+    assert cache.get('b') is None
+    assert cache.get('c') == b'1234'
+    assert cache.size == 8
+
+def test_lru_cache_skips_values_bigger_than_max_bytes():
+    cache = LRUCache(max_bytes=2)
+    cache.set('a', b'1234')
+    assert len(cache) == 0
@@ -0,0 +1,194 @@
+from pytest import raises
+
+from dag import CompactDAG, DAG, DAGValidationError
+
+
+def build(graph):
+    d = DAG()
+    for node in graph:
+        d.add_node(node)
+    for node, edges in graph.items():
+        for edge in edges:
+            d.add_edge(node, edge)
+    return d
+
+
+# topological_sort - ts
+
+def test_ts_sorts_a_chain():
+    d = build({'c': [], 'a': ['b'], 'b': ['c']})
+    assert d.topological_sort() == ['a', 'b', 'c']
+
+def test_ts_breaks_ties_by_name():
+    d = build({'z': [], 'y': ['x'], 'x': [], 'b': ['a'], 'a': []})
+    assert d.topological_sort() == ['b', 'y', 'z', 'a', 'x']
+
+def test_ts_is_breadth_first_like_before():
+    d = build({'a': ['b', 'c'], 'b': ['d'], 'c': [], 'd': []})
+    assert d.topological_sort() == ['a', 'b', 'c', 'd']
+
+def test_ts_waits_for_all_dependencies():
+    d = build({'a': ['c'], 'b': ['d'], 'd': ['c'], 'c': []})
+    assert d.topological_sort() == ['a', 'b', 'd', 'c']
+
+def test_ts_leaves_graph_alone():
+    d = build({'a': ['b'], 'b': []})
+    d.topological_sort()
+    assert d.graph == {'a': {'b'}, 'b': set()}
+
+def test_ts_sorts_an_empty_graph():
+    assert DAG().topological_sort() == []
+
+def test_ts_rejects_cycles():
+    d = DAG()
+    with raises(ValueError):
+        d.topological_sort({'a': {'b'}, 'b': {'a'}, 'c': set()})
+
+
+# reverse_graph - rg
+
+def test_rg_tracks_incoming_edges():
+    d = build({'a': ['b', 'c'], 'b': ['c'], 'c': []})
+    assert d.reverse_graph == {'a': set(), 'b': {'a'}, 'c': {'a', 'b'}}
+    assert sorted(d.incoming('c')) == ['a', 'b']
+    assert sorted(d.predecessors('c')) == ['a', 'b']
+    assert d.incoming('a') == []
+
+def test_rg_incoming_rejects_unknown_node():
+    with raises(KeyError):
+        DAG().incoming('a')
+
+def test_rg_follows_delete_node():
+    d = build({'a': ['b'], 'b': ['c'], 'c': []})
+    d.delete_node('b')
+    assert d.graph == {'a': set(), 'c': set()}
+    assert d.reverse_graph == {'a': set(), 'c': set()}
+
+def test_rg_follows_delete_edge():
+    d = build({'a': ['b'], 'b': []})
+    d.delete_edge('a', 'b')
+    assert d.incoming('b') == []
+
+def test_rg_follows_rename_edges():
+    d = build({'a': ['b'], 'b': ['c'], 'c': []})
+    d.rename_edges('b', 'x')
+    assert d.graph == {'a': {'x'}, 'x': {'c'}, 'c': set()}
+    assert d.reverse_graph == {'a': set(), 'x': {'a'}, 'c': {'x'}}
+
+def test_rg_leaves_foreign_graphs_alone():
+    d = build({'a': []})
+    graph = {'x': {'y'}, 'y': set()}
+    d.delete_node('y', graph)
+    assert graph == {'x': set()}
+    assert d.reverse_graph == {'a': set()}
+
+
+# from_edges - fe
+
+def test_fe_builds_a_dag():
+    d = DAG.from_edges(['a', 'b', 'c'], [('a', 'b'), ('b', 'c')])
+    assert d.graph == {'a': {'b'}, 'b': {'c'}, 'c': set()}
+    assert d.reverse_graph == {'a': set(), 'b': {'a'}, 'c': {'b'}}
+
+def test_fe_rejects_unknown_nodes():
+    with raises(KeyError):
+        DAG.from_edges(['a'], [('a', 'b')])
+
+def test_fe_reports_every_cycle_at_once():
+    edges = [('a', 'b'), ('b', 'a'), ('c', 'd'), ('d', 'e'), ('e', 'c'), ('e', 'f'), ('g', 'g')]
+    with raises(DAGValidationError) as err:
+        DAG.from_edges('abcdefg', edges)
+    assert err.value.cycles == [['a', 'b', 'a'], ['c', 'd', 'e', 'c'], ['g', 'g']]
+    assert str(err.value) == 'graph is not acyclic: a -> b -> a; c -> d -> e -> c; g -> g'
+
+def test_from_dict_builds_a_dag():
+    d = DAG()
+    d.from_dict({'a': ['b'], 'b': []})
+    assert d.graph == {'a': {'b'}, 'b': set()}
+    assert d.incoming('b') == ['a']
+
+def test_add_edge_rejects_cycles():
+    d = build({'a': ['b'], 'b': ['c'], 'c': []})
+    with raises(DAGValidationError):
+        d.add_edge('c', 'a')
+    with raises(DAGValidationError):
+        d.add_edge('a', 'a')
+    assert d.graph == {'a': {'b'}, 'b': {'c'}, 'c': set()}
+
+
+# CompactDAG - cd
+
+def test_cd_matches_dag():
+    d = build({'c': ['a'], 'b': ['a', 'd'], 'a': [], 'd': []})
+    c = d.compact()
+    assert c.names == ('a', 'b', 'c', 'd')
+    assert c.topological_sort() == d.topological_sort() == ['b', 'c', 'd', 'a']
+    assert c.downstream('b') == ['a', 'd']
+    assert c.incoming('a') == ['b', 'c']
+    assert c.all_downstreams('b') == ['d', 'a']
+    assert c.all_leaves() == ['a', 'd']
+    assert c.ind_nodes() == ['b', 'c']
+    assert 'a' in c and 'z' not in c
+    assert len(c) == 4
+
+def test_cd_stores_adjacency_as_arrays():
+    c = CompactDAG.from_edges(['x', 'y', 'z'], [('x', 'z'), ('x', 'y'), ('y', 'z')])
+    assert list(c.offsets) == [0, 2, 3, 3]
+    assert list(c.targets) == [1, 2, 2]
+    assert list(c.reverse_offsets) == [0, 0, 1, 3]
+    assert list(c.reverse_targets) == [0, 0, 1]
+
+def test_cd_round_trips_to_dag():
+    d = build({'a': ['b'], 'b': []})
+    assert d.compact().to_dag().graph == d.graph
+
+def test_cd_rejects_unknown_nodes():
+    c = CompactDAG.from_edges(['a'], [])
+    with raises(KeyError):
+        c.downstream('b')
+    with raises(KeyError):
+        CompactDAG.from_edges(['a'], [('a', 'b')])
+
+def test_cd_reports_cycles():
+    with raises(DAGValidationError) as err:
+        CompactDAG.from_edges(['a', 'b'], [('a', 'b'), ('b', 'a')])
+    assert err.value.cycles == [['a', 'b', 'a']]
+
+
+# transitive closure - tc
+
+def test_tc_answers_downstream_and_upstream_queries():
+    d = build({'a': ['b', 'c'], 'b': ['d'], 'c': ['d'], 'd': [], 'e': ['c']})
+    assert d.all_downstreams('a') == ['b', 'c', 'd']
+    assert d.all_downstreams('d') == []
+    assert d.all_upstreams('d') == ['a', 'e', 'b', 'c']
+    assert d.reaches('a', 'd')
+    assert d.reaches('e', 'd')
+    assert not d.reaches('b', 'c')
+    assert not d.reaches('d', 'a')
+
+def test_tc_matches_scanning_for_foreign_graphs():
+    d = build({'a': ['b'], 'b': ['c'], 'c': []})
+    assert d.all_downstreams('a') == d.all_downstreams('a', {k: set(v) for k, v in d.graph.items()})
+
+def test_tc_is_invalidated_on_mutation():
+    d = build({'a': ['b'], 'b': [], 'c': []})
+    assert d.all_downstreams('a') == ['b']
+    d.add_edge('b', 'c')
+    assert d.all_downstreams('a') == ['b', 'c']
+    d.delete_edge('a', 'b')
+    assert d.all_downstreams('a') == []
+    d.rename_edges('c', 'x')
+    assert d.all_upstreams('x') == ['b']
+    d.delete_node('b')
+    assert d.all_upstreams('x') == []
+
+def test_tc_lets_add_edge_reject_cycles():
+    d = build({'a': ['b'], 'b': ['c'], 'c': []})
+    assert d.reaches('a', 'c')
+    with raises(DAGValidationError):
+        d.add_edge('c', 'a')
+
+def test_tc_rejects_unknown_node():
+    with raises(KeyError):
+        DAG().all_downstreams('a')
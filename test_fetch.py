@@ -0,0 +1,217 @@
+import json
+import os
+import time
+
+import fetch
+from cache import DiskCache
+from pytest import raises
+
+
+CSV = """\
+uid,subtopic_id,before_this,after_this,resource_name
+a,sub,,b,Alpha
+b,sub,a,,Beta
+c,sub,b,c,Gamma
+d,other,a,,Delta
+"""
+
+
+def test_fetch_resources_by_topic_builds_dags(monkeypatch):
+    monkeypatch.setattr(fetch, '_get', lambda url: CSV)
+    topics = fetch.fetch_resources_by_topic([('topic', 'http://example.com/topic.csv')])
+    sub = topics['topic']['subtopics']['sub']
+    assert sub['id'] == 'sub'
+    assert sub['topic_id'] == 'topic'
+    assert sub['dag']['names'] == ['a', 'b', 'c']
+    assert sub['dag']['vertices'] == { 'a': {'incomingNames': ['b']}
+                                     , 'b': {'incomingNames': ['c']}
+                                     , 'c': {'incomingNames': []}
+                                      }
+    assert sub['resources']['a']['resource_name'] == 'Alpha'
+    assert topics['topic']['subtopics']['other']['dag']['names'] == ['d']
+
+
+def test_fetch_resources_by_topic_keeps_worksheet_order(monkeypatch):
+    def get(url):
+        time.sleep(0.05 if url.endswith('first') else 0)
+        return "uid,subtopic_id,before_this,after_this\n{0},sub,,\n".format(url[-5:])
+    monkeypatch.setattr(fetch, '_get', get)
+    worksheets = [('one', 'http://example.com/first'), ('two', 'http://example.com/later')]
+    topics = fetch.fetch_resources_by_topic(worksheets, max_workers=2)
+    assert list(topics) == ['one', 'two']
+    assert list(topics['one']['subtopics']['sub']['resources']) == ['first']
+    assert list(topics['two']['subtopics']['sub']['resources']) == ['later']
+
+
+def test_fetch_resources_by_topic_flags_stale_copies(monkeypatch, tmpdir):
+    monkeypatch.setattr(fetch, 'cache', DiskCache(str(tmpdir)))
+    fetch.cache.set('http://example.com/down', CSV.encode('utf8'))
+    def get(url):
+        if url.endswith('down'):
+            raise fetch.SheetUnavailable(url, 500)
+        return CSV
+    monkeypatch.setattr(fetch, '_get', get)
+    worksheets = [('down', 'http://example.com/down'), ('fine', 'http://example.com/fine')]
+    topics = fetch.fetch_resources_by_topic(worksheets)
+    assert topics['down']['stale']
+    assert 'stale' not in topics['fine']
+
+class FakeResponse(object):
+    def __init__(self, status_code, text='', headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+
+
+def test_get_sends_validators_and_reuses_body_on_304(monkeypatch, tmpdir):
+    monkeypatch.setattr(fetch, 'cache', DiskCache(str(tmpdir)))
+    sent = []
+    responses = [ FakeResponse(200, CSV, {'ETag': '"v1"', 'Last-Modified': 'Mon, 1 Jan 2016'})
+                , FakeResponse(304)
+                 ]
+    def get(url, headers, **kw):
+        sent.append(headers)
+        return responses.pop(0)
+    monkeypatch.setattr(fetch.session, 'get', get)
+    assert fetch._get('http://example.com/topic.csv') == CSV
+    assert fetch._get('http://example.com/topic.csv') == CSV
+    assert sent == [{}, {'If-None-Match': '"v1"', 'If-Modified-Since': 'Mon, 1 Jan 2016'}]
+
+
+def test_update_topics_only_rebuilds_changed_worksheets(monkeypatch):
+    sheets = {'http://example.com/a': CSV, 'http://example.com/b': CSV}
+    monkeypatch.setattr(fetch, '_get', lambda url: sheets[url])
+    worksheets = [('a', 'http://example.com/a'), ('b', 'http://example.com/b')]
+    topics, hashes, changed = fetch.update_topics(worksheets, {}, {})
+    assert changed == ['a', 'b']
+
+    sheets['http://example.com/b'] = CSV.replace('Beta', 'Bravo')
+    old = topics
+    topics, hashes, changed = fetch.update_topics(worksheets, old, hashes)
+    assert changed == ['b']
+    assert topics['a'] is old['a']
+    assert topics['b']['subtopics']['sub']['resources']['b']['resource_name'] == 'Bravo'
+
+    topics, hashes, changed = fetch.update_topics(worksheets[:1], topics, hashes)
+    assert changed == ['b']
+    assert list(topics) == ['a']
+
+
+def test_main_incremental_skips_unchanged_rewrite(monkeypatch, tmpdir):
+    monkeypatch.setattr(fetch, 'fetch_worksheets', lambda key: [('a', 'http://example.com/a')])
+    monkeypatch.setattr(fetch, '_get', lambda url: CSV)
+    staging, final = str(tmpdir.join('.topics.json')), str(tmpdir.join('topics.json'))
+    assert fetch.main('key', staging, final, incremental=True) == ['a']
+    mtime = os.stat(final).st_mtime_ns
+    assert fetch.main('key', staging, final, incremental=True) == []
+    assert os.stat(final).st_mtime_ns == mtime
+    assert json.load(open(fetch.manifest_path(final)))['changed'] == []
+
+
+class FakeStreamingResponse(FakeResponse):
+    def iter_content(self, chunk_size, decode_unicode):
+        for i in range(0, len(self.text), 7):
+            yield self.text[i:i+7]
+    def close(self):
+        pass
+    encoding = None
+
+
+def test_stream_topic_parses_rows_as_they_arrive(monkeypatch, tmpdir):
+    monkeypatch.setattr(fetch, 'cache', DiskCache(str(tmpdir)))
+    quoted = CSV + 'e,sub,,,"Two\nlines"\n'
+    monkeypatch.setattr(fetch.session, 'get',
+                        lambda url, headers, **kw: FakeStreamingResponse(200, quoted, {'ETag': 'x'}))
+    topic, sha1, bad = fetch.stream_topic('topic', 'http://example.com/topic.csv', fields=[])
+    assert sha1 == fetch.hashlib.sha1(quoted.encode('utf8')).hexdigest()
+    assert bad == set()
+    resources = topic['subtopics']['sub']['resources']
+    assert resources['a'] == { 'uid': 'a', 'subtopic_id': 'sub', 'before_this': '', 'after_this': 'b'
+                             , 'id': 'a', 'topic_id': 'topic'
+                              }
+    assert topic['subtopics']['sub']['dag']['names'] == ['a', 'e', 'b', 'c']
+    assert fetch.cache.get('http://example.com/topic.csv')[0] == quoted.encode('utf8')
+
+    monkeypatch.setattr(fetch.session, 'get',
+                        lambda url, headers, **kw: FakeStreamingResponse(304))
+    again = fetch.stream_topic('topic', 'http://example.com/topic.csv', fields=['resource_name'])
+    assert again[1] == sha1
+    assert again[0]['subtopics']['sub']['resources']['e']['resource_name'] == 'Two\nlines'
+
+
+def test_stream_topic_closes_the_cached_copy_if_the_request_fails(monkeypatch, tmpdir):
+    monkeypatch.setattr(fetch, 'cache', DiskCache(str(tmpdir)))
+    fetch.cache.set('http://example.com/topic.csv', CSV.encode('utf8'))
+    opened = []
+    def open_(url, open_=fetch.cache.open):
+        opened.append(open_(url))
+        return opened[-1]
+    monkeypatch.setattr(fetch.cache, 'open', open_)
+    def get(url, headers, **kw):
+        raise fetch.requests.ConnectionError(url)
+    monkeypatch.setattr(fetch.session, 'get', get)
+    with raises(fetch.requests.ConnectionError):
+        fetch.stream_topic('topic', 'http://example.com/topic.csv')
+    assert opened[0][0].closed
+
+
+def test_stream_topic_checks_uids_in_the_same_pass(monkeypatch, tmpdir):
+    monkeypatch.setattr(fetch, 'cache', DiskCache(str(tmpdir)))
+    monkeypatch.setattr(fetch.session, 'get', lambda url, headers, **kw:
+                        FakeStreamingResponse(200, CSV.replace('c,sub', 'C!,sub')))
+    topic, sha1, bad = fetch.stream_topic('topic', 'http://example.com/topic.csv')
+    assert bad == {('topic', 'uid', b'C!')}
+
+
+def test_update_topics_falls_back_to_stale_copies(monkeypatch, tmpdir):
+    monkeypatch.setattr(fetch, 'cache', DiskCache(str(tmpdir)))
+    fetch.cache.set('http://example.com/slow', CSV.encode('utf8'))
+    fetch.cache.set('http://example.com/down', CSV.encode('utf8'))
+    def get(url):
+        if url.endswith('slow'):
+            time.sleep(0.5)
+        if url.endswith('down'):
+            raise fetch.SheetUnavailable(url, 500)
+        return CSV
+    monkeypatch.setattr(fetch, '_get', get)
+    worksheets = [ ('slow', 'http://example.com/slow')
+                 , ('down', 'http://example.com/down')
+                 , ('fine', 'http://example.com/fine')
+                  ]
+    start = time.time()
+    topics, hashes, changed = fetch.update_topics(worksheets, {}, {}, deadline=time.time() + 0.1)
+    assert time.time() - start < 0.4
+    assert topics['slow']['stale'] and topics['down']['stale']
+    assert 'stale' not in topics['fine']
+    assert topics['slow']['subtopics']['sub']['dag']['names'] == ['a', 'b', 'c']
+
+    monkeypatch.setattr(fetch, '_get', lambda url: CSV)
+    topics, hashes, changed = fetch.update_topics(worksheets, topics, hashes)
+    assert changed == ['down', 'slow']
+    assert not any('stale' in topic for topic in topics.values())
+
+
+def test_fetch_csvs_starts_no_downloads_after_the_deadline(monkeypatch, tmpdir):
+    monkeypatch.setattr(fetch, 'cache', DiskCache(str(tmpdir)))
+    started = []
+    def get(url):
+        started.append(url)
+        time.sleep(0.2)
+        return CSV
+    monkeypatch.setattr(fetch, '_get', get)
+    worksheets = [(str(i), 'http://example.com/{}'.format(i)) for i in range(8)]
+    for topic_id, csvurl in worksheets:
+        fetch.cache.set(csvurl, CSV.encode('utf8'))
+    csvs = list(fetch.fetch_csvs(worksheets, max_workers=2, deadline=time.time() + 0.1))
+    assert all(stale for topic_id, raw, stale in csvs)
+    time.sleep(0.5)
+    assert len(started) == 2
+
+
+def test_update_topics_gives_up_without_a_cached_copy(monkeypatch, tmpdir):
+    monkeypatch.setattr(fetch, 'cache', DiskCache(str(tmpdir)))
+    def get(url):
+        raise fetch.SheetUnavailable(url, 500)
+    monkeypatch.setattr(fetch, '_get', get)
+    with raises(SystemExit):
+        fetch.update_topics([('down', 'http://example.com/down')], {}, {})
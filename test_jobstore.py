@@ -0,0 +1,112 @@
+import time
+
+import server
+from jobstore import JobStore
+
+
+TOPICS = {'t': {'id': 't', 'subtopics': {'s': { 'id': 's'
+                                              , 'dag': {'names': ['a', 'b']}
+                                              , 'resources': {'a': {'id': 'a'}, 'b': {'id': 'b'}}
+                                               }}}}
+
+
+def job(**kw):
+    return server.Job('http://example.com/callback', TOPICS, dict({'width': 256, 'height': 256}, **kw))
+
+
+def test_store_queues_jobs_up_to_depth(tmpdir):
+    store = JobStore(str(tmpdir.join('jobs.db')))
+    first, second = job(), job(width=258)
+    assert store.put(first, 2, depth=2)
+    assert store.put(second, 1, depth=2)
+    assert not store.put(job(width=260), 3, depth=2)
+    assert store.count('queued') == 2
+    assert store.position(store.get(first.id)) == 1
+    assert store.get(first.id)['request'] == [TOPICS, {'width': 256, 'height': 256}]
+
+
+def test_store_claims_lowest_rank_first_and_only_once(tmpdir):
+    store = JobStore(str(tmpdir.join('jobs.db')))
+    slow, fast = job(), job(width=258)
+    store.put(slow, 2, depth=4)
+    store.put(fast, 1, depth=4)
+    assert store.claim('r1', 60, ['fast'])['id'] == fast.id
+    assert store.claim('r2', 60, ['fast'])['id'] == slow.id
+    assert store.claim('r3', 60, ['fast']) is None
+    assert store.get(fast.id)['runner'] == 'r1'
+
+
+def test_store_hands_out_jobs_again_when_leases_run_out(tmpdir):
+    store = JobStore(str(tmpdir.join('jobs.db')))
+    queued = job()
+    store.put(queued, 1, depth=4)
+    assert store.claim('r1', -1, ['fast'])['id'] == queued.id  # r1's lease is already up
+    assert store.claim('r2', 60, ['fast'])['attempts'] == 1
+    assert not store.renew(queued.id, 'r1', 60)
+    assert store.renew(queued.id, 'r2', 60)
+
+    queued.runner, queued.status = 'r1', 'failed'  # r1 comes back to life, too late
+    assert not store.save(queued)
+    assert store.get(queued.id)['status'] == 'running'
+    queued.runner, queued.status = 'r2', 'done'
+    assert store.save(queued)
+    assert store.get(queued.id)['status'] == 'done'
+    assert store.get(queued.id)['request'] is None
+
+
+def test_store_has_identical_jobs_follow_the_one_in_line(tmpdir):
+    store = JobStore(str(tmpdir.join('jobs.db')))
+    leader, follower, other = job(), job(), job(width=258)
+    assert store.put(leader, 1, depth=1)
+    assert store.put(follower, 2, depth=1)  # doesn't take a place in line
+    assert not store.put(other, 3, depth=1)
+    assert store.get(follower.id)['leader'] == leader.id
+    assert store.get(follower.id)['request'] is None
+    assert store.count('queued') == 1
+    assert [row['id'] for row in store.followers(leader.id)] == [follower.id]
+
+
+def test_store_finishes_followers_along_with_their_leader(tmpdir):
+    store = JobStore(str(tmpdir.join('jobs.db')))
+    leader, follower = job(), job()
+    store.put(leader, 1, depth=1)
+    store.put(follower, 2, depth=1)
+    store.claim('r1', 60, ['fast'])
+    leader.runner = 'r1'
+    leader.status, leader.svg_path, leader.finished_at = 'done', '/tmp/map.svg', time.time()
+    assert store.save(leader)
+    row = store.get(follower.id)
+    assert (row['status'], row['svg_path'], row['finished_at']) == ('done', '/tmp/map.svg', leader.finished_at)
+    assert [row['id'] for row in store.followers(leader.id)] == [follower.id]
+
+
+def test_store_fails_jobs_that_keep_losing_their_runners(tmpdir):
+    store = JobStore(str(tmpdir.join('jobs.db')))
+    doomed, follower = job(), job()
+    store.put(doomed, 1, depth=4)
+    store.put(follower, 1, depth=4)
+    assert store.claim('r1', -1, ['fast'], max_attempts=2)['id'] == doomed.id
+    assert store.claim('r2', -1, ['fast'], max_attempts=2)['id'] == doomed.id
+    assert store.claim('r3', 60, ['fast'], max_attempts=2) is None
+    row = store.get(doomed.id)
+    assert (row['status'], row['attempts'], row['request']) == ('failed', 2, None)
+    assert row['error'] == 'Gave up after 2 attempts, none of which finished.'
+    assert store.get(follower.id)['status'] == 'failed'
+
+
+def test_store_leaves_jobs_it_was_told_about_to_their_process(tmpdir):
+    store = JobStore(str(tmpdir.join('jobs.db')))
+    store.add(job())
+    assert store.claim('r1', 60, ['fast']) is None
+
+
+def test_store_expires_finished_jobs_and_their_svgs(tmpdir):
+    store = JobStore(str(tmpdir.join('jobs.db')))
+    finished = job()
+    finished.status, finished.finished_at = 'done', time.time() - 90
+    finished.svg_path = str(tmpdir.join('jobs-svg', 'map.svg'))
+    open(finished.svg_path, 'w').close()
+    store.add(finished)
+    store.expire(60)
+    assert store.get(finished.id) is None
+    assert not tmpdir.join('jobs-svg', 'map.svg').exists()
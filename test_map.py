@@ -737,3 +737,33 @@ def test_ai_doesnt_cross_pathways():
     actual = list(filter(lambda a: [b[1] for b in a['art']] == list('wxyz'), actual))
 
     assert actual == expected
+
+
+def test_estimate_counts_what_a_map_will_take():
+    topics = {'t': {'id': 't', 'subtopics': {'s': { 'id': 's'
+                                                  , 'dag': {'names': ['a', 'b']}
+                                                  , 'resources': {'a': {'id': 'a'}, 'b': {'id': 'b'}}
+                                                   }}}}
+    estimate = genmap.estimate(topics, width=256, height=256)
+    assert estimate['resources'] == 2
+    assert estimate['solver_nodes'] == 2
+    assert estimate['cells'] > 256 * 256
+    assert estimate['feasible']
+
+    assert genmap.estimate(topics, width=64, height=64)['problem'] == 'the canvas is too small for topic t'
+    assert genmap.estimate({}, width=256, height=256)['problem'] == 'there are no topics'
+    empty = {'t': {'id': 't', 'subtopics': {}}}
+    assert genmap.estimate(empty, width=256, height=256)['problem'] == 'topic t has no resources'
+    many = {'r{}'.format(i): {'id': 'r{}'.format(i)} for i in range(200)}
+    topics['t']['subtopics']['s']['resources'] = many
+    estimate = genmap.estimate(topics, width=256, height=256)
+    assert not estimate['feasible']
+    assert estimate['solver_nodes'] == genmap.SOLVER_NODES_PER_TOPIC
+
+
+def test_fill_one_gives_up_at_its_deadline():
+    from deadlines import Deadline, DeadlineExceeded
+    deadline = Deadline(60)
+    deadline.cancel()
+    with raises(DeadlineExceeded):
+        genmap.fill_one('-# ', 'test', (64, 64), [('a', 1)], 2, 4, monkeys=False, deadline=deadline)
@@ -0,0 +1,41 @@
+import threading
+
+import metrics
+
+
+def test_histograms_render_cumulative_buckets():
+    histogram = metrics.Histogram('test_seconds', 'Test seconds.', (0.1, 1))
+    for value in (0.05, 0.5, 0.5, 5):
+        histogram.record(value)
+    assert histogram.render() == [ '# HELP test_seconds Test seconds.'
+                                 , '# TYPE test_seconds histogram'
+                                 , 'test_seconds_bucket{le="0.1"} 1'
+                                 , 'test_seconds_bucket{le="1"} 3'
+                                 , 'test_seconds_bucket{le="+Inf"} 4'
+                                 , 'test_seconds_sum 6.05'
+                                 , 'test_seconds_count 4'
+                                  ]
+
+def test_counters_render_by_label():
+    counter = metrics.Counter('test_total', 'Test total.')
+    counter.record(outcome='b')
+    counter.record(2, outcome='a')
+    assert counter.render()[2:] == ['test_total{outcome="a"} 2', 'test_total{outcome="b"} 1']
+    assert counter.get(outcome='a') == 2
+
+def test_capture_holds_observations_for_replay():
+    counter = metrics.Counter('test_captured_total', 'Test total.')
+    with metrics.capture() as captured:
+        metrics.observe('test_captured_total', 3)
+        other = threading.Thread(target=metrics.observe, args=('test_captured_total',))
+        other.start()
+        other.join()
+    assert captured == [('test_captured_total', 3, {})]
+    assert counter.get() == 1  # the other thread wasn't capturing
+    metrics.replay(captured)
+    assert counter.get() == 4
+
+def test_render_includes_every_metric():
+    text = metrics.render()
+    assert '# TYPE caac_fill_one_seconds histogram' in text
+    assert '# TYPE caac_callbacks_total counter' in text
@@ -0,0 +1,34 @@
+import io
+import os
+
+import fetch
+import genmap
+import pipeline
+import sources
+from cache import DiskCache
+
+
+def test_pipeline_renders_fetched_topics_in_process(monkeypatch, tmpdir):
+    monkeypatch.setattr(fetch, 'cache', DiskCache(str(tmpdir.join('cache'))))
+    sources.synthesize(str(tmpdir.join('sheets')), ntopics=2, nrows=4)
+    rendered = {}
+    def generate_map(topics, **kw):
+        rendered['topics'], rendered['kw'] = topics, kw
+        return 'big', 'blocks'
+    def output_svg(topics, fp, big, blocks):
+        assert topics is rendered['topics']
+        print('<svg/>', file=fp)
+    monkeypatch.setattr(genmap, 'generate_map', generate_map)
+    monkeypatch.setattr(genmap, 'output_svg', output_svg)
+
+    fp = io.StringIO()
+    staging, final = str(tmpdir.join('.topics.json')), str(tmpdir.join('topics.json'))
+    source = sources.Directory(str(tmpdir.join('sheets')))
+    changed = pipeline.main(source, fp, staging, final, width=512)
+
+    assert changed == ['topic-000', 'topic-001']
+    assert sorted(rendered['topics']) == changed
+    assert rendered['kw'] == {'width': 512}
+    assert fp.getvalue() == '<svg/>\n'
+    assert os.path.exists(final)
+    assert os.path.exists(fetch.snapshot_path(final))
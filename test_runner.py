@@ -0,0 +1,178 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+import requests
+
+import runner
+import server
+from cache import LRUCache
+from jobstore import JobStore
+
+
+TOPICS = {'t': {'id': 't', 'subtopics': {'s': { 'id': 's'
+                                              , 'dag': {'names': ['a', 'b']}
+                                              , 'resources': {'a': {'id': 'a'}, 'b': {'id': 'b'}}
+                                               }}}}
+
+
+def post_json(client, url, body):
+    return client.post(url, data=json.dumps(body), content_type='application/json')
+
+
+def read_json(response):
+    return json.loads(response.get_data(as_text=True))
+
+
+@pytest.fixture
+def store(monkeypatch, tmpdir):
+    store = JobStore(str(tmpdir.join('jobs.db')))
+    monkeypatch.setattr(server, 'store', store)
+    monkeypatch.setattr(server, 'SVG_DIR', store.svg_dir)
+    monkeypatch.setattr(server, 'PROCESSES', 0)
+    monkeypatch.setattr(server, 'svg_cache', server.SVGCache(LRUCache(1024 * 1024)))
+    monkeypatch.setattr(server.delivery, 'submit', lambda job: None)
+    return store
+
+
+def test_runner_runs_jobs_queued_by_the_server(store):
+    client = server.app.test_client()
+    body = {'callback_url': 'http://example.com/callback', 'topics': TOPICS, 'width': 256, 'height': 256}
+    job_id = read_json(post_json(client, '/v1', body))['id']
+    status = read_json(client.get('/v1/jobs/' + job_id))
+    assert (status['status'], status['position']) == ('queued', 0)
+
+    assert runner.run_one(store, 'test-runner')
+    assert not runner.run_one(store, 'test-runner')
+
+    status = read_json(client.get('/v1/jobs/' + job_id))
+    assert status['status'] == 'done'
+    svg = client.get('/v1/jobs/' + job_id + '/svg')
+    assert svg.get_data().startswith(b'<svg')
+    svg.close()
+    assert store.get(job_id)['svg_path'].startswith(store.svg_dir)
+
+
+def test_server_records_cached_jobs_in_the_store(store):
+    client = server.app.test_client()
+    body = {'callback_url': 'http://example.com/callback', 'topics': TOPICS, 'width': 256, 'height': 256}
+    post_json(client, '/v1', body)
+    runner.run_one(store, 'test-runner')
+    job_id = read_json(post_json(client, '/v1', body))['id']
+    assert read_json(client.get('/v1/jobs/' + job_id))['status'] == 'done'
+    assert store.count('done') == 2
+
+
+def test_server_serves_repeats_of_jobs_a_separate_runner_did(store):
+    client = server.app.test_client()
+    body = {'callback_url': 'http://example.com/callback', 'topics': TOPICS, 'width': 256, 'height': 256}
+    post_json(client, '/v1', body)
+    script = ("import runner, server; server.delivery.submit = lambda job: None; "
+              "assert runner.run_one(server.store, 'other-runner')")
+    env = dict(os.environ, CAAC_JOB_STORE=store.path, CAAC_PROCESSES='0')
+    subprocess.check_call([sys.executable, '-c', script], cwd=os.path.dirname(__file__) or '.', env=env)
+    job_id = read_json(post_json(client, '/v1', body))['id']
+    assert read_json(client.get('/v1/jobs/' + job_id))['status'] == 'done'
+
+
+def test_runners_resume_callbacks_left_pending(store, monkeypatch):
+    client = server.app.test_client()
+    body = {'callback_url': 'http://example.com/callback', 'topics': TOPICS, 'width': 256, 'height': 256}
+    leader = read_json(post_json(client, '/v1', body))['id']
+    follower = read_json(post_json(client, '/v1', body))['id']
+    runner.run_one(store, 'test-runner')  # and dies before delivering anything
+    delivered = []
+    monkeypatch.setattr(server.delivery, 'submit', delivered.append)
+    assert runner.resume_callbacks(store) == 2
+    assert sorted(job.id for job in delivered) == sorted([leader, follower])
+    job = delivered[0]
+    job.callback['status'] = 'delivered'
+    assert job.save()
+    assert store.get(job.id)['callback']['status'] == 'delivered'
+    assert runner.resume_callbacks(store) == 1
+
+
+def test_server_records_renders_in_progress_as_running(store, monkeypatch):
+    seen = []
+    def render_in_pool(topics, kwargs, deadline=None, render_in_pool=server.render_in_pool):
+        seen.append((store.count('queued'), store.count('running')))
+        return render_in_pool(topics, kwargs, deadline)
+    monkeypatch.setattr(server, 'render_in_pool', render_in_pool)
+    client = server.app.test_client()
+    response = post_json(client, '/v1/render', {'topics': TOPICS, 'width': 256, 'height': 256})
+    assert response.status_code == 200
+    assert seen == [(0, 1)]
+    assert store.get(response.headers['X-Job-Id'])['status'] == 'done'
+
+
+def test_runner_stops_jobs_it_loses_the_lease_on(store, monkeypatch):
+    delivered = []
+    monkeypatch.setattr(server.delivery, 'submit', delivered.append)
+    client = server.app.test_client()
+    body = {'callback_url': 'http://example.com/callback', 'topics': TOPICS, 'width': 256, 'height': 256}
+    job_id = read_json(post_json(client, '/v1', body))['id']
+
+    def render_in_pool(topics, kwargs, deadline=None):
+        store.connect().execute("UPDATE jobs SET runner='another-runner'")  # it took over
+        deadline.start()
+        for i in range(500):
+            if deadline.expired():
+                break
+            time.sleep(0.01)
+        deadline.check()
+    monkeypatch.setattr(server, 'render_in_pool', render_in_pool)
+    start = time.time()
+    assert runner.run_one(store, 'test-runner', lease=0.3)
+    assert time.time() - start < 1  # stopped, not left to run out its own clock
+    assert delivered == []
+    row = store.get(job_id)
+    assert (row['status'], row['runner']) == ('running', 'another-runner')
+
+
+def test_identical_jobs_in_the_store_share_one_render(store, monkeypatch):
+    delivered = []
+    monkeypatch.setattr(server.delivery, 'submit', delivered.append)
+    client = server.app.test_client()
+    body = {'callback_url': 'http://example.com/callback', 'topics': TOPICS, 'width': 256, 'height': 256}
+    ids = [read_json(post_json(client, '/v1', body))['id'] for i in range(3)]
+    assert store.count('queued') == 1
+    assert read_json(client.get('/v1/jobs/' + ids[2]))['position'] == 0
+
+    assert runner.run_one(store, 'test-runner')
+    assert not runner.run_one(store, 'test-runner')
+    assert sorted(job.id for job in delivered) == sorted(ids)
+    paths = {store.get(job_id)['svg_path'] for job_id in ids}
+    assert len(paths) == 1 and None not in paths
+    assert [read_json(client.get('/v1/jobs/' + job_id))['status'] for job_id in ids] == ['done'] * 3
+
+
+def test_runners_teach_web_processes_how_long_jobs_take(store, monkeypatch):
+    monkeypatch.setattr(server, 'runtimes', server.RuntimeHistory(store=store))
+    web = server.RuntimeHistory(store=store)  # in another process, say
+    client = server.app.test_client()
+    body = {'callback_url': 'http://example.com/callback', 'topics': TOPICS, 'width': 256, 'height': 256}
+    job_id = read_json(post_json(client, '/v1', body))['id']
+    estimate = store.get(job_id)['estimate']
+    assert web.predict(estimate) == estimate['cost'] * web.seconds_per_cost
+
+    runner.run_one(store, 'test-runner')
+    row = store.get(job_id)
+    assert web.predict(estimate) == row['finished_at'] - row['started_at']
+
+
+def test_runners_serve_their_own_metrics(store):
+    client = server.app.test_client()
+    body = {'callback_url': 'http://example.com/callback', 'topics': TOPICS, 'width': 256, 'height': 256}
+    post_json(client, '/v1', body)
+    runner.run_one(store, 'test-runner')
+    httpd = runner.serve_metrics(0)
+    try:
+        response = requests.get('http://127.0.0.1:{}/metrics'.format(httpd.server_port), timeout=5)
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+    assert response.status_code == 200
+    assert 'caac_job_seconds_count' in response.text
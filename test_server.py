@@ -0,0 +1,468 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+
+import genmap
+import metrics
+import server
+from cache import LRUCache
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+    def close(self):
+        pass
+
+
+class FakeSession(object):
+    """Record callback POSTs, answering with the given statuses (or raising), then 200s.
+    """
+
+    def __init__(self, *answers):
+        self.answers = list(answers)
+        self.posted = []
+
+    def post(self, url, data, headers, timeout):
+        self.posted.append((url, data.read()))
+        answer = self.answers.pop(0) if self.answers else 200
+        if isinstance(answer, Exception):
+            raise answer
+        return FakeResponse(answer)
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch):
+    monkeypatch.setattr(server, 'svg_cache', server.SVGCache(LRUCache(1024 * 1024)))
+    monkeypatch.setattr(server, 'in_flight', server.SingleFlight())
+    monkeypatch.setattr(server, 'delivery', server.Delivery(2, timeout=1, retries=2, backoff=0.01))
+    server.delivery.session = FakeSession()
+
+
+def wait_for(condition):
+    deadline = time.time() + 5
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    assert condition()
+
+
+class FakeJob(server.Job):
+
+    def run(self):
+        release.wait(5)
+
+
+release = threading.Event()
+
+
+def post_json(client, url, body):
+    return client.post(url, data=json.dumps(body), content_type='application/json')
+
+
+def read_json(response):
+    return json.loads(response.get_data(as_text=True))
+
+
+def post(client, **kw):
+    body = {'callback_url': 'http://example.com/callback', 'topics': TOPICS}
+    body.update(kw)
+    return post_json(client, '/v1', body)
+
+
+def test_v1_queues_jobs_and_turns_them_away_when_full(monkeypatch):
+    monkeypatch.setattr(server, 'Job', FakeJob)
+    monkeypatch.setattr(server, 'pool', server.WorkerPool(1, server.JobQueue(1)))
+    release.clear()
+    client = server.app.test_client()
+
+    assert post(client, width=256).status_code == 200    # running
+    wait_for(lambda: not len(server.pool.queue))
+    assert post(client, width=258).status_code == 200    # queued
+    assert post(client, width=256).status_code == 200    # following the first
+
+    response = post(client, width=260)                   # turned away
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == str(server.RETRY_AFTER)
+
+    release.set()
+
+
+def test_job_queue_knows_positions():
+    queue = server.JobQueue(3)
+    queue.put('a')
+    queue.put('b')
+    assert queue.position('b') == 1
+    assert queue.get() == 'a'
+    assert queue.position('b') == 0
+    assert queue.position('a') is None
+
+
+def make_topics(ntopics, nresources):
+    resources = {'r{}'.format(i): {'id': 'r{}'.format(i)} for i in range(nresources)}
+    return {'t{}'.format(i): {'subtopics': {'s': {'resources': resources}}} for i in range(ntopics)}
+
+
+class Queued(object):
+
+    def __init__(self, name, topics, size, waited):
+        self.name = name
+        self.estimate = genmap.estimate(topics, width=size, height=size)
+        self.submitted_at = time.time() - waited
+
+
+def test_job_queue_runs_shortest_jobs_first_but_ages_long_ones(monkeypatch):
+    monkeypatch.setattr(server, 'runtimes', server.RuntimeHistory())
+    monkeypatch.setattr(server, 'AGING', 1)
+    queue = server.JobQueue(4, server.shortest_first)
+    big = Queued('big', make_topics(3, 7), 4096, 0)      # 33 million cells
+    small = Queued('small', make_topics(2, 9), 512, 0)   # more resources, on 400 thousand cells
+    old = Queued('old', make_topics(3, 7), 4096, 495)
+    for job in (big, small, old):
+        queue.put(job)
+    assert queue.position(old) == 0
+    assert queue.position(big) == 2
+    assert [queue.get().name for i in range(3)] == ['old', 'small', 'big']  # ~3 < ~15 < ~498 seconds
+
+
+def test_runtime_history_learns_from_similar_jobs():
+    history = server.RuntimeHistory(alpha=0.5, seconds_per_cost=1)
+    small = {'cells': 1000, 'resources': 2, 'cost': 1000}
+    assert history.predict(small) == 1000
+    history.record(small, 4)
+    history.record(small, 2)
+    assert history.predict(small) == 3
+    assert history.predict(dict(small, cells=1010, cost=1010)) == 3  # same bucket
+    big = {'cells': 10 ** 6, 'resources': 2, 'cost': 10 ** 6}
+    assert history.predict(big) < 10 ** 6  # scaled by what we've learned about seconds per cost
+
+
+TOPICS = {'t': {'id': 't', 'subtopics': {'s': { 'id': 's'
+                                              , 'dag': {'names': ['a', 'b']}
+                                              , 'resources': {'a': {'id': 'a'}, 'b': {'id': 'b'}}
+                                               }}}}
+
+
+def test_render_in_pool_writes_svg_to_a_file(monkeypatch):
+    monkeypatch.setattr(server, 'PROCESSES', 1)
+    path = server.render_in_pool(TOPICS, {'width': 256, 'height': 256})
+    try:
+        svg = open(path).read()
+    finally:
+        os.remove(path)
+    assert svg.startswith('<svg')
+    assert 'id="a"' in svg and 'id="b"' in svg
+
+
+def die(topics, kwargs, deadline=None):
+    os._exit(1)  # as if killed for running out of memory
+
+
+def test_render_in_pool_starts_a_new_pool_when_a_process_dies(monkeypatch):
+    monkeypatch.setattr(server, 'PROCESSES', 1)
+    monkeypatch.setattr(server, '_processes', None)
+    render = server.render
+    monkeypatch.setattr(server, 'render', die)
+    with pytest.raises(server.BrokenProcessPool):
+        server.render_in_pool(TOPICS, {'width': 256, 'height': 256})
+    monkeypatch.setattr(server, 'render', render)
+    try:
+        path = server.render_in_pool(TOPICS, {'width': 256, 'height': 256})
+        os.remove(path)
+    finally:
+        server._processes.shutdown()
+
+
+def test_job_posts_rendered_svg_to_callback(monkeypatch):
+    monkeypatch.setattr(server, 'PROCESSES', 0)
+    job = server.Job('http://example.com/callback', TOPICS, {'width': 256, 'height': 256})
+    job.run()
+    wait_for(lambda: job.callback['status'] == 'delivered')
+    job.discard()
+    [(url, svg)] = server.delivery.session.posted
+    assert url == 'http://example.com/callback'
+    assert svg.startswith(b'<svg')
+    assert server.delivery.stats['delivered'] == 1
+
+
+def test_delivery_retries_with_backoff_then_gives_up(tmpdir):
+    path = tmpdir.join('map.svg')
+    path.write('<svg/>')
+    server.delivery.session = FakeSession(503, server.requests.ConnectionError('nope'), 200)
+    job = server.Job('http://example.com/callback', {}, {})
+    job.svg_path = str(path)
+    server.delivery.submit(job)
+    wait_for(lambda: job.callback['status'] == 'delivered')
+    assert job.callback['attempts'] == 3
+    assert server.delivery.stats['retried'] == 2
+
+    server.delivery.session = FakeSession(500, 500, 500, 500)
+    job = server.Job('http://example.com/callback', {}, {})
+    job.svg_path = str(path)
+    server.delivery.submit(job)
+    wait_for(lambda: job.callback['status'] == 'failed')
+    assert job.callback == {'status': 'failed', 'attempts': 3, 'error': 'HTTP 500'}
+    assert server.delivery.stats['failed'] == 1
+
+
+def test_delivery_does_not_retry_client_errors(tmpdir):
+    path = tmpdir.join('map.svg')
+    path.write('<svg/>')
+    server.delivery.session = FakeSession(404)
+    job = server.Job('http://example.com/callback', {}, {})
+    job.svg_path = str(path)
+    server.delivery.submit(job)
+    wait_for(lambda: job.callback['status'] == 'failed')
+    assert job.callback['attempts'] == 1
+
+
+def test_jobs_can_be_polled_and_fetched(monkeypatch):
+    monkeypatch.setattr(server, 'PROCESSES', 0)
+    monkeypatch.setattr(server, 'pool', server.WorkerPool(1, server.JobQueue(4)))
+    monkeypatch.setattr(server, 'jobs', server.Jobs(60))
+    client = server.app.test_client()
+
+    response = post(client, topics=TOPICS, width=256, height=256)
+    job_id = read_json(response)['id']
+    assert read_json(response)['url'] == '/v1/jobs/' + job_id
+    wait_for(lambda: read_json(client.get('/v1/jobs/' + job_id))['status'] not in ('queued', 'running'))
+    status = read_json(client.get('/v1/jobs/' + job_id))
+    assert status['status'] == 'done'
+    assert status['started_at'] <= status['finished_at']
+
+    svg = client.get('/v1/jobs/' + job_id + '/svg')
+    assert svg.mimetype == 'image/svg+xml'
+    assert svg.get_data().startswith(b'<svg')
+    svg.close()
+    assert client.get('/v1/jobs/nope').status_code == 404
+    server.jobs.get(job_id).discard()
+
+
+def test_failed_jobs_say_why(monkeypatch):
+    def render_in_pool(topics, kwargs, deadline=None):
+        raise ValueError('too small')
+    monkeypatch.setattr(server, 'render_in_pool', render_in_pool)
+    monkeypatch.setattr(server, 'jobs', server.Jobs(60))
+    job = server.Job('http://example.com/callback', TOPICS, {})
+    server.jobs.add(job)
+    try:
+        job.run()
+    except ValueError:
+        pass
+    client = server.app.test_client()
+    assert read_json(client.get('/v1/jobs/' + job.id))['error'] == 'ValueError: too small'
+    assert client.get('/v1/jobs/' + job.id + '/svg').status_code == 409
+
+
+def test_jobs_expire_after_ttl(tmpdir):
+    jobs = server.Jobs(60)
+    job = server.Job('http://example.com/callback', TOPICS, {})
+    job.svg_path = str(tmpdir.join('map.svg'))
+    open(job.svg_path, 'w').close()
+    jobs.add(job)
+    job.finished_at = time.time() - 30
+    assert jobs.get(job.id) is job
+    job.finished_at = time.time() - 90
+    assert jobs.get(job.id) is None
+    assert not os.path.exists(job.svg_path)
+
+
+def test_request_key_only_depends_on_what_affects_the_map():
+    key = server.request_key(TOPICS, {'width': 256, 'height': 256})
+    shuffled = {'t': {'id': 't', 'extra': 1, 'subtopics': {'s': { 'id': 's'
+                                                                , 'dag': {'names': ['a', 'b']}
+                                                                , 'resources': { 'b': {'id': 'b', 'name': 'B'}
+                                                                               , 'a': {'id': 'a'}
+                                                                                }
+                                                                 }}}}
+    assert server.request_key(shuffled, {'height': '256', 'width': 256}) == key
+    assert server.request_key(TOPICS, {'width': 256, 'height': 256, 'alley_width': 6}) == key
+    assert server.request_key(TOPICS, {'width': 512, 'height': 256}) != key
+
+
+def test_repeat_requests_are_answered_from_cache(monkeypatch, tmpdir):
+    monkeypatch.setattr(server, 'PROCESSES', 0)
+    monkeypatch.setattr(server, 'jobs', server.Jobs(60))
+    monkeypatch.setattr(server, 'svg_cache', server.SVGCache(LRUCache(1024 * 1024),
+                                                             server.DiskCache(str(tmpdir))))
+    posted = server.delivery.session.posted
+    job = server.Job('http://example.com/callback', TOPICS, {'width': 256, 'height': 256})
+    job.run()
+    wait_for(lambda: posted)
+    job.discard()
+
+    def render_in_pool(topics, kwargs, deadline=None):
+        raise AssertionError('should have been cached')
+    monkeypatch.setattr(server, 'render_in_pool', render_in_pool)
+    server.svg_cache.memory = LRUCache(1024 * 1024)  # make it come from disk
+    client = server.app.test_client()
+    job_id = read_json(post(client, topics=TOPICS, width=256, height=256))['id']
+    assert read_json(client.get('/v1/jobs/' + job_id))['status'] == 'done'
+    wait_for(lambda: len(posted) >= 2)
+    assert posted[0][1] == posted[1][1]
+    assert server.svg_cache.memory.get(job.key) == posted[0][1]
+    server.jobs.get(job_id).discard()
+
+
+def test_identical_jobs_in_flight_share_one_render(monkeypatch):
+    monkeypatch.setattr(server, 'PROCESSES', 0)
+    monkeypatch.setattr(server, 'pool', server.WorkerPool(1, server.JobQueue(1)))
+    monkeypatch.setattr(server, 'jobs', server.Jobs(60))
+    renders = []
+    go = threading.Event()
+    def render_in_pool(topics, kwargs, deadline=None):
+        go.wait(5)
+        renders.append(kwargs)
+        return server.render(topics, kwargs)[0]
+    monkeypatch.setattr(server, 'render_in_pool', render_in_pool)
+    posted = server.delivery.session.posted
+    client = server.app.test_client()
+
+    ids = [read_json(post(client, callback_url='http://example.com/{}'.format(i), topics=TOPICS,
+                          width=256, height=256))['id'] for i in range(3)]
+    for i in ids:
+        assert read_json(client.get('/v1/jobs/' + i))['status'] in ('queued', 'running')
+    go.set()
+    wait_for(lambda: len(posted) >= 3)
+
+    assert len(renders) == 1
+    assert sorted(url for url, svg in posted) == ['http://example.com/0', 'http://example.com/1',
+                                                  'http://example.com/2']
+    assert len(set(svg for url, svg in posted)) == 1
+    assert client.get('/v1/jobs/' + ids[2] + '/svg').get_data() == posted[0][1]
+    server.jobs.get(ids[0]).discard()
+
+
+def test_followers_serve_their_leaders_svg_before_they_land(monkeypatch, tmpdir):
+    monkeypatch.setattr(server, 'jobs', server.Jobs(60))
+    leader = server.Job(None, TOPICS, {'width': 256, 'height': 256})
+    follower = server.Job(None, TOPICS, {'width': 256, 'height': 256})
+    follower.leader = leader
+    leader.followers.append(follower)
+    server.jobs.add(follower)
+    leader.svg_path = str(tmpdir.join('map.svg'))
+    tmpdir.join('map.svg').write('<svg/>')
+    leader.status = 'done'  # but the follower hasn't followed it yet
+    client = server.app.test_client()
+    assert read_json(client.get('/v1/jobs/' + follower.id))['status'] == 'done'
+    assert client.get('/v1/jobs/' + follower.id + '/svg').get_data() == b'<svg/>'
+
+
+def test_metrics_cover_a_job(monkeypatch):
+    monkeypatch.setattr(server, 'PROCESSES', 0)
+    before = metrics.REGISTRY['caac_fill_one_iterations'].count
+    job = server.Job('http://example.com/callback', TOPICS, {'width': 256, 'height': 256})
+    job.run()
+    wait_for(lambda: job.callback['status'] == 'delivered')
+    job.discard()
+    assert metrics.REGISTRY['caac_fill_one_iterations'].count == before + 2  # big and one block
+    text = server.app.test_client().get('/metrics').get_data(as_text=True)
+    for name in ('caac_queue_depth', 'caac_jobs_active', 'caac_cache_hit_ratio', 'caac_job_seconds_count',
+                 'caac_solver_nodes_bucket', 'caac_svg_render_seconds_sum',
+                 'caac_callbacks_total{outcome="delivered"}'):
+        assert name in text
+
+
+def test_render_answers_small_maps_in_the_response(monkeypatch):
+    monkeypatch.setattr(server, 'PROCESSES', 0)
+    monkeypatch.setattr(server, 'jobs', server.Jobs(60))
+    client = server.app.test_client()
+    response = post_json(client, '/v1/render', {'topics': TOPICS, 'width': 256, 'height': 256})
+    assert response.status_code == 200
+    assert response.mimetype == 'image/svg+xml'
+    svg = response.get_data()
+    assert svg.startswith(b'<svg')
+
+    def render_in_pool(topics, kwargs, deadline=None):
+        raise AssertionError('should have been cached')
+    monkeypatch.setattr(server, 'render_in_pool', render_in_pool)
+    monkeypatch.setattr(server, 'SYNC_MAX_SECONDS', 0)
+    again = post_json(client, '/v1/render', {'topics': TOPICS, 'width': 256, 'height': 256})
+    assert again.get_data() == svg
+    assert server.delivery.session.posted == []
+    for job_id in (response.headers['X-Job-Id'], again.headers['X-Job-Id']):
+        server.jobs.get(job_id).discard()
+
+
+def test_render_queues_slow_maps(monkeypatch):
+    monkeypatch.setattr(server, 'Job', FakeJob)
+    monkeypatch.setattr(server, 'pool', server.WorkerPool(1, server.JobQueue(1)))
+    monkeypatch.setattr(server, 'SYNC_MAX_SECONDS', 0)
+    release.clear()
+    client = server.app.test_client()
+    response = post_json(client, '/v1/render', {'topics': TOPICS, 'width': 256, 'height': 256})
+    assert response.status_code == 202
+    assert read_json(response)['url'] == '/v1/jobs/' + read_json(response)['id']
+    release.set()
+
+
+def test_render_queues_maps_while_busy_rendering_others(monkeypatch):
+    monkeypatch.setattr(server, 'Job', FakeJob)
+    monkeypatch.setattr(server, 'pool', server.WorkerPool(1, server.JobQueue(1)))
+    monkeypatch.setattr(server, 'sync_renders', server.threading.BoundedSemaphore(1))
+    release.clear()
+    client = server.app.test_client()
+    server.sync_renders.acquire()
+    response = post_json(client, '/v1/render', {'topics': TOPICS, 'width': 256, 'height': 256})
+    assert response.status_code == 202
+    server.sync_renders.release()
+    release.set()
+
+
+def test_v1_turns_away_maps_that_can_never_fit():
+    client = server.app.test_client()
+    response = post(client, width=64, height=64)
+    assert response.status_code == 422
+    assert read_json(response)['estimate']['problem'] == 'the canvas is too small for topic t'
+    response = post(client, topics={'t': {'id': 't', 'subtopics': {}}}, width=256, height=256)
+    assert response.status_code == 422
+
+
+def test_v1_sends_expensive_jobs_to_the_slow_pool(monkeypatch):
+    monkeypatch.setattr(server, 'Job', FakeJob)
+    monkeypatch.setattr(server, 'pool', server.WorkerPool(1, server.JobQueue(1)))
+    monkeypatch.setattr(server, 'slow_pool', server.WorkerPool(1, server.JobQueue(1)))
+    monkeypatch.setattr(server, 'jobs', server.Jobs(60))
+    monkeypatch.setattr(server, 'EXPENSIVE_COST', 100000)
+    release.clear()
+    client = server.app.test_client()
+
+    cheap = read_json(post(client, width=256, height=256))
+    expensive = read_json(post(client, width=512, height=512))
+    assert cheap['estimate']['cost'] <= 100000 < expensive['estimate']['cost']
+    assert server.jobs.get(cheap['id']).pool is server.pool
+    assert server.jobs.get(expensive['id']).pool is server.slow_pool
+    status = read_json(client.get(expensive['url']))
+    assert status['estimate'] == expensive['estimate']
+    release.set()
+
+
+def test_the_real_map_is_not_expensive():
+    topics = json.load(open('output/topics.json'))
+    assert server.Job(None, topics, {'width': 1024, 'height': 1024}).lane == 'fast'
+    assert server.Job(None, topics, {'width': 4096, 'height': 4096}).lane == 'slow'
+
+
+def test_jobs_time_out(monkeypatch):
+    monkeypatch.setattr(server, 'PROCESSES', 0)
+    monkeypatch.setattr(server, 'JOB_TIMEOUT', 1e-9)
+    job = server.Job('http://example.com/callback', TOPICS, {'width': 256, 'height': 256})
+    try:
+        job.run()
+    except server.DeadlineExceeded:
+        pass
+    assert job.status == 'timed out'
+    assert job.error.startswith('DeadlineExceeded: gave up after')
+    assert job.svg_path is None
+
+
+def test_job_deadlines_start_when_rendering_does():
+    deadline = server.Deadline(1, start=False)
+    time.sleep(1.1)  # waiting for a pool process, say
+    path, observations = server.render(TOPICS, {'width': 256, 'height': 256}, deadline)
+    os.remove(path)
+    assert not deadline.expired()
@@ -0,0 +1,40 @@
+import json
+
+import snapshot
+from pytest import raises
+
+
+TOPICS = json.load(open('output/topics.json'))
+
+
+def test_snapshot_round_trips_what_genmap_needs(tmpdir):
+    path = str(tmpdir.join('topics.snapshot'))
+    snapshot.dump(TOPICS, path)
+    snap = snapshot.load(path)
+    assert sorted(snap) == sorted(TOPICS)
+    for topic_id, topic in TOPICS.items():
+        loaded = snap[topic_id]
+        assert loaded['id'] == topic_id
+        assert sorted(loaded['subtopics']) == sorted(topic['subtopics'])
+        for subtopic_id, subtopic in topic['subtopics'].items():
+            assert loaded['subtopics'][subtopic_id]['dag']['names'] == subtopic['dag']['names']
+            assert sorted(loaded['subtopics'][subtopic_id]['resources']) == \
+                   sorted(subtopic['resources'])
+
+def test_snapshot_is_much_smaller_than_json(tmpdir):
+    path = tmpdir.join('topics.snapshot')
+    snapshot.dump(TOPICS, str(path))
+    assert path.size() * 10 < len(json.dumps(TOPICS))
+
+def test_snapshot_loads_topics_lazily(tmpdir):
+    path = str(tmpdir.join('topics.snapshot'))
+    snapshot.dump(TOPICS, path)
+    snap = snapshot.load(path)
+    snap['robotics']
+    assert list(snap._topics) == ['robotics']
+
+def test_snapshot_rejects_other_files(tmpdir):
+    path = tmpdir.join('topics.json')
+    path.write('{}')
+    with raises(snapshot.BadSnapshot):
+        snapshot.load(str(path))
@@ -38,3 +38,19 @@ def test_next_sibling_properly_identifies_base_case():
     P.indices = [(0,0)]
     s = {'foo': [('a', 'x'), ('b', 'y')]}
     assert ps.next_(P, s) == None
+
+
+# deadlines
+
+def test_solve_checks_its_deadline_as_it_goes():
+    from deadlines import Deadline, DeadlineExceeded
+    shapes = {'s{}'.format(i): (i * 10, 0, (10, 10)) for i in range(6)}
+    pathways = {'p': ['r{}'.format(i) for i in range(6)]}
+    deadline = Deadline(60)
+    deadline.cancel()
+    try:
+        ps.solve(shapes, pathways, deadline=deadline)
+    except DeadlineExceeded:
+        pass
+    else:
+        assert False, 'should have given up'
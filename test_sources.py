@@ -0,0 +1,40 @@
+import fetch
+import sources
+from cache import DiskCache
+
+
+def test_directory_source_replays_synthesized_sheets(monkeypatch, tmpdir):
+    monkeypatch.setattr(fetch, 'cache', DiskCache(str(tmpdir.join('cache'))))
+    listing = sources.synthesize(str(tmpdir.join('sheets')), ntopics=3, nrows=20)
+    worksheets = sources.Directory(str(tmpdir.join('sheets'))).worksheets()
+    assert [title for title, url in worksheets] == [title for title, filename in listing]
+    topics, hashes, changed = fetch.update_topics(worksheets, {}, {})
+    assert changed == ['topic-000', 'topic-001', 'topic-002']
+    assert sum(len(s['resources']) for s in topics['topic-001']['subtopics'].values()) == 20
+
+    streamed, streamed_hashes, changed = fetch.update_topics(worksheets, {}, {}, stream=True)
+    assert streamed_hashes == hashes
+
+def test_served_directory_supports_conditional_requests(monkeypatch, tmpdir):
+    monkeypatch.setattr(fetch, 'cache', DiskCache(str(tmpdir.join('cache'))))
+    sources.synthesize(str(tmpdir), ntopics=2, nrows=5)
+    server = sources.serve(str(tmpdir))
+    try:
+        worksheets = sources.Replay(server.base_url).worksheets()
+        first = fetch.fetch_resources_by_topic(worksheets)
+        second = fetch.fetch_resources_by_topic(worksheets)
+    finally:
+        server.shutdown()
+    assert first == second
+    assert len(fetch.cache.entries()) == 3
+
+def test_record_writes_a_replayable_directory(monkeypatch, tmpdir):
+    monkeypatch.setattr(fetch, '_get', lambda url: 'uid,subtopic_id,before_this,after_this\n')
+    listing = sources.record([('Art + Design', 'http://example.com/a')], str(tmpdir))
+    assert listing == [['Art + Design', '000-art-design.csv']]
+    assert tmpdir.join('000-art-design.csv').read() == 'uid,subtopic_id,before_this,after_this\n'
+
+def test_bench_reports_cold_and_warm_timings(tmpdir):
+    sources.synthesize(str(tmpdir), ntopics=2, nrows=5)
+    results = sources.bench(sources.Directory(str(tmpdir)), workers=(1, 2))
+    assert [nworkers for nworkers, cold, warm in results] == [1, 2]